@@ -0,0 +1,3 @@
+#!/usr/bin/env python3
+
+# Benchmarks for pyMusicSync, see __main__.py
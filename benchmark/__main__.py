@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# python -m benchmark [--shape shape.json] [--baseline FILE] [--save-baseline FILE]
+# Run from the repository root, the local ffmpeg is used both to build the library and to sync it
+
+import argparse
+import json
+import logging
+import shutil
+import sys
+
+from benchmark import library, runner
+
+SIZES = {
+    "small": {"artists": 3, "albumsPerArtist": 2, "tracksPerAlbum": 8},
+    "medium": {"artists": 20, "albumsPerArtist": 5, "tracksPerAlbum": 12},
+    "large": {"artists": 100, "albumsPerArtist": 10, "tracksPerAlbum": 12}
+}
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Time full, no-op and incremental syncs of a synthetic library")
+    parser.add_argument("-w", "--work", default="./benchmark-work",
+                        help="Directory holding the library, destination and logs, reused across runs")
+    parser.add_argument("-s", "--size", choices=sorted(SIZES), default="small", help="Preset library shape")
+    parser.add_argument("--shape", metavar="FILE", help="JSON file overriding the library shape")
+    parser.add_argument("--settings", metavar="FILE",
+                        help="JSON file with config options for the sync (threadNum, encoderSetting...)")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Run every scenario this many times, keep the best")
+    parser.add_argument("-o", "--output", metavar="FILE", help="Save the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare the results to a saved baseline")
+    parser.add_argument("--save-baseline", metavar="FILE", help="Save the results as a new baseline")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown (0.1 = 10%%) reported as a regression when comparing to the baseline")
+    return parser.parse_args()
+
+
+def loadJson(filePath):
+    with open(filePath) as f:
+        return json.load(f)
+
+
+def main():
+    logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    args = parseArgs()
+    if shutil.which("ffmpeg") is None:
+        logging.error("ffmpeg not found, it's needed to build the library")
+        return 2
+
+    shapeConfig = dict(SIZES[args.size])
+    if args.shape is not None:
+        shapeConfig.update(loadJson(args.shape))
+    shape = library.LibraryShape(shapeConfig)
+    settings = loadJson(args.settings) if args.settings is not None else {}
+
+    result = runner.Benchmark(args.work, shape, settings).run(args.repeat)
+    for filePath in (args.output, args.save_baseline):
+        if filePath is not None:
+            with open(filePath, "w") as f:
+                json.dump(result, f, indent=4)
+            logging.info("Results saved to {}".format(filePath))
+
+    if args.baseline is not None:
+        regressions = runner.compare(result, loadJson(args.baseline), args.threshold)
+        if regressions:
+            logging.error("{} regression(s) over {:.0f}%".format(len(regressions), args.threshold * 100))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
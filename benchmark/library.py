@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# Synthetic music libraries, made of short tone clips encoded by the local FFmpeg
+# Every album is derived from (seed, index), so the same shape always gives the same library
+
+import concurrent.futures
+import json
+import os
+import random
+import shutil
+import subprocess
+
+from PIL import Image
+
+from pyMusicSync import utils
+
+# Extension and FFmpeg encoder of every format
+FORMATS = {
+    "flac": (".flac", ["-c:a", "flac"]),
+    "mp3": (".mp3", ["-c:a", "libmp3lame", "-q:a", "5"]),
+    "opus": (".opus", ["-c:a", "libopus", "-b:a", "64k"])
+}
+# Titles shared by many albums
+COMMON_TITLES = ["Intro", "Outro", "Interlude", "Untitled", "Bonus Track"]
+# Names exercising unidecode and pathSanitize
+UNICODE_WORDS = ["Ünïcødé", "東京", "Пётр", "Ελληνικά", "café", "naïve", "🎵", "AC/DC", "What?", "A:B", "<Live>"]
+WORDS = ["Blue", "Night", "River", "Glass", "Echo", "Static", "Summer", "Paper", "Silver", "Ghost", "Garden", "Signal"]
+
+
+class LibraryShape:
+    OPTIONAL_OPTIONS = {
+        "seed": 0,
+        "artists": 5,
+        "albumsPerArtist": 4,
+        "tracksPerAlbum": 10,
+        "clipSeconds": 1.0,  # Shortest track, the others are up to twice as long
+        # Relative weight of every format, an album uses a single format
+        "formats": {"flac": 5, "mp3": 3, "opus": 2},
+        # Fraction of albums split into CD1, CD2... folders
+        "multiDisc": 0.1,
+        # Fraction of track titles taken from COMMON_TITLES
+        "duplicateTitles": 0.1,
+        # Fraction of names with non-ASCII or illegal characters
+        "unicodeNames": 0.2,
+        # Fraction of albums with a cover.jpg, and its width/height
+        "covers": 0.7,
+        "coverSize": 600
+    }
+
+    def __init__(self, config):
+        for key, default in self.OPTIONAL_OPTIONS.items():
+            self.__setattr__(key, utils.getKey(config, key, default=default))
+
+    def toDict(self):
+        result = {}
+        for key in self.OPTIONAL_OPTIONS.keys():
+            result[key] = getattr(self, key)
+        return result
+
+    @property
+    def albums(self):
+        return self.artists * self.albumsPerArtist
+
+
+class Library:
+    """ A synthetic library under root
+        Albums 0 to shape.albums - 1 make up the base library, higher indices are used
+        for incremental changes """
+    SHAPE_FILE = ".shape.json"
+
+    def __init__(self, root, shape, workers=None):
+        self.root = root
+        self.shape = shape
+        self.workers = workers or os.cpu_count() or 1
+
+    def __name(self, rnd, words=2):
+        name = " ".join(rnd.choice(WORDS) for _ in range(words))
+        if rnd.random() < self.shape.unicodeNames:
+            name = "{} {}".format(name, rnd.choice(UNICODE_WORDS))
+        return name
+
+    def __album(self, index):
+        """ Tags and paths of every track of album index, without touching the disk """
+        shape = self.shape
+        rnd = random.Random("{}-{}".format(shape.seed, index))
+        artistIndex = index % shape.artists
+        artist = "{} {}".format(self.__name(random.Random("{}-artist-{}".format(shape.seed, artistIndex))),
+                                artistIndex)
+        title = "{} {}".format(self.__name(rnd, 3), index)
+        formats = sorted(shape.formats)
+        fmt = rnd.choices(formats, weights=[shape.formats[name] for name in formats])[0]
+        discs = 2 if rnd.random() < shape.multiDisc else 1
+        directory = os.path.join(self.root, self.__dirName(artist), self.__dirName(title))
+        tracks = []
+        for number in range(1, shape.tracksPerAlbum + 1):
+            disc = 1 + (number - 1) * discs // shape.tracksPerAlbum
+            if rnd.random() < shape.duplicateTitles:
+                trackTitle = rnd.choice(COMMON_TITLES)
+            else:
+                trackTitle = self.__name(rnd)
+            folder = directory if discs == 1 else os.path.join(directory, "CD{}".format(disc))
+            tracks.append({
+                "path": os.path.join(folder, "{:02d} {}{}".format(number, self.__dirName(trackTitle), FORMATS[fmt][0])),
+                "format": fmt,
+                # A distinct tone per track, so content fingerprints don't collide
+                "frequency": 110 + (index * shape.tracksPerAlbum + number) % 3000 + rnd.random(),
+                # Metadata IDs hash album, title and duration, duplicate titles need distinct durations
+                "seconds": shape.clipSeconds * (1 + 0.1 * (number % 10)),
+                "tags": {
+                    "artist": artist,
+                    "album_artist": artist,
+                    "album": title,
+                    "title": trackTitle,
+                    "track": str(number),
+                    "disc": str(disc),
+                    "date": str(1960 + index % 60),
+                    "genre": rnd.choice(["Rock", "Jazz", "Electronic", "Classical"])
+                }
+            })
+        cover = rnd.random() < shape.covers
+        color = tuple(rnd.randrange(256) for _ in range(3))
+        return directory, tracks, cover and color
+
+    @staticmethod
+    def __dirName(name):
+        # Keep illegal characters in the tags, but not in the source tree
+        return name.replace("/", "-")
+
+    @staticmethod
+    def __makeTrack(track):
+        param = ["ffmpeg", "-v", "error", "-nostdin", "-y",
+                 "-f", "lavfi", "-i", "sine=frequency={:.3f}:duration={:.2f}:sample_rate=48000".format(
+                     track["frequency"], track["seconds"]),
+                 "-ac", "2"]
+        for key, value in track["tags"].items():
+            param.extend(["-metadata", "{}={}".format(key, value)])
+        param.extend(FORMATS[track["format"]][1])
+        param.append(track["path"])
+        subprocess.run(param, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def __makeCover(self, directory, color):
+        size = (self.shape.coverSize, self.shape.coverSize)
+        Image.new("RGB", size, color).save(os.path.join(directory, "cover.jpg"), "jpeg", quality=90)
+
+    def addAlbums(self, indices):
+        """ Write albums to disk, return the number of tracks written """
+        jobs = []
+        for index in indices:
+            directory, tracks, cover = self.__album(index)
+            for track in tracks:
+                os.makedirs(os.path.dirname(track["path"]), exist_ok=True)
+                jobs.append(track)
+            if cover:
+                os.makedirs(directory, exist_ok=True)
+                self.__makeCover(directory, cover)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for future in [executor.submit(self.__makeTrack, track) for track in jobs]:
+                future.result()
+        return len(jobs)
+
+    def removeAlbums(self, indices):
+        """ Delete albums from disk, along with artist folders left empty """
+        for index in indices:
+            directory = self.__album(index)[0]
+            shutil.rmtree(directory, ignore_errors=True)
+            artistDirectory = os.path.dirname(directory)
+            if os.path.isdir(artistDirectory) and not os.listdir(artistDirectory):
+                os.rmdir(artistDirectory)
+
+    def generate(self):
+        """ Write the base library, unless root already holds one of the same shape """
+        shapeFile = os.path.join(self.root, self.SHAPE_FILE)
+        if os.path.isfile(shapeFile):
+            with open(shapeFile) as f:
+                if json.load(f) == self.shape.toDict():
+                    return False
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root)
+        self.addAlbums(range(self.shape.albums))
+        with open(shapeFile, "w") as f:
+            json.dump(self.shape.toDict(), f, indent=4)
+        return True
+
+    def trackCount(self):
+        return self.shape.albums * self.shape.tracksPerAlbum
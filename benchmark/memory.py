@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# python -m benchmark.memory [-n 200000] [--baseline FILE] [--save-baseline FILE]
+# Memory taken by the in-memory model of a large library, without touching the disk:
+# scan index entries, the scanned ID set, albums and tracks waiting to be synced, the record
+
+import argparse
+import json
+import logging
+import sys
+import tracemalloc
+
+from pyMusicSync import objects, timing, utils
+
+
+def synthetic(count, tracksPerAlbum=12, albumsPerArtist=8):
+    """ Yield (path, size, mtime_ns, Metadata) for count tracks
+        Every string is built per track, like the copies unpickled from the scanner processes """
+    for index in range(count):
+        albumIndex = index // tracksPerAlbum
+        artist = "Artist {}".format(albumIndex // albumsPerArtist)
+        album = "Album {}".format(albumIndex)
+        title = "Title {}".format(index)
+        metadata = objects.Metadata(album=album, albumartist=artist, artist=artist, title=title,
+                                    track=str(index % tracksPerAlbum + 1), disc="1",
+                                    duration=180.0 + index % 97, bitrate=900.0, samplerate=44100,
+                                    year=str(1960 + albumIndex % 60), genre=["Rock", "Jazz", "Pop"][albumIndex % 3])
+        path = "/music/{}/{}/{:02d} {}.flac".format(artist, album, index % tracksPerAlbum + 1, title)
+        yield path, 30000000 + index, 1600000000000000000 + index, metadata
+
+
+def measure(count):
+    """ Return the bytes allocated per component, and in total """
+    tracemalloc.start()
+    components = {}
+    previous = tracemalloc.get_traced_memory()[0]
+
+    def checkpoint(name):
+        nonlocal previous
+        current = tracemalloc.get_traced_memory()[0]
+        components[name] = current - previous
+        previous = current
+
+    scanEntries = {}  # Same layout as ScanIndex.entries
+    for path, size, mtime, metadata in synthetic(count):
+        scanEntries[path] = (size, mtime, metadata)
+    checkpoint("scanIndex")
+
+    trackIDList = set(utils.genID(metadata) for _, _, metadata in scanEntries.values())
+    checkpoint("trackIDList")
+
+    albums = {}
+    for path, (_, _, metadata) in scanEntries.items():
+        track = objects.Track(metadata, path, utils.genID(metadata))
+        if track.album not in albums:
+            albums[track.album] = objects.Album(track.album)
+        albums[track.album].add(track)
+    checkpoint("albums")
+
+    record = {}  # Same layout as Record.record
+    for album in albums.values():
+        for track in album.tracks:
+            record[track.trackID] = "{}/{}.mp3".format(album.title, track.title)
+    checkpoint("record")
+
+    total, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "tracks": count,
+        "components": components,
+        "total": total,
+        "peak": peak,
+        "maxRSS": timing.maxRSS()
+    }
+
+
+def compare(result, baseline, threshold):
+    regressions = []
+    for name in sorted(result["components"]) + ["total", "peak"]:
+        new = result["components"].get(name, result.get(name))
+        old = baseline["components"].get(name, baseline.get(name))
+        if not old:
+            continue
+        ratio = new / old
+        regressed = ratio > 1 + threshold
+        logging.info("{:<12} {:7.1f} -> {:7.1f} bytes/track ({:+.1f}%){}".format(
+            name, old / baseline["tracks"], new / result["tracks"], (ratio - 1) * 100,
+            " REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Measure the memory taken by the in-memory library model")
+    parser.add_argument("-n", "--tracks", type=int, default=200000)
+    parser.add_argument("--baseline", metavar="FILE", help="Compare the results to a saved baseline")
+    parser.add_argument("--save-baseline", metavar="FILE", help="Save the results as a new baseline")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Growth (0.1 = 10%%) reported as a regression when comparing to the baseline")
+    args = parser.parse_args()
+
+    result = measure(args.tracks)
+    for name, size in result["components"].items():
+        logging.info("{:<12} {:7.1f} MiB, {:5.0f} bytes/track".format(name, size / 2 ** 20, size / args.tracks))
+    logging.info("Total {:.1f} MiB, peak {:.1f} MiB, max RSS {:.1f} MiB".format(
+        result["total"] / 2 ** 20, result["peak"] / 2 ** 20, (result["maxRSS"] or 0) / 2 ** 20))
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["tracks"] != result["tracks"]:
+            logging.warning("Baseline was measured with {} tracks, comparing per track".format(baseline["tracks"]))
+            scale = result["tracks"] / baseline["tracks"]
+            baseline["components"] = {name: size * scale for name, size in baseline["components"].items()}
+            baseline["total"] *= scale
+            baseline["peak"] *= scale
+            baseline["tracks"] = result["tracks"]
+        if compare(result, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Sync scenarios run against a synthetic library
+# Every sync is a separate main.py process, exactly like a real run, and its
+# stage timings are read back from the run report
+
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+from benchmark.library import Library
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+REPORT = "run_report.json"
+# In order, every scenario starts from the state the previous one left
+SCENARIOS = ["full", "noop", "add", "remove"]
+
+
+class Benchmark:
+    VERSION = 1
+    # Albums added by "add", then removed again by "remove"
+    INCREMENTAL_ALBUMS = 2
+
+    def __init__(self, workDirectory, shape, settings=None):
+        self.workDirectory = os.path.abspath(workDirectory)
+        self.shape = shape
+        self.settings = settings or {}
+        self.library = Library(os.path.join(self.workDirectory, "library"), shape)
+        self.destination = os.path.join(self.workDirectory, "destination")
+        self.cacheDirectory = os.path.join(self.workDirectory, "cache")
+        self.logDirectory = os.path.join(self.workDirectory, "logs")
+        self.configFile = os.path.join(self.workDirectory, "config.json")
+
+    def __writeConfig(self):
+        config = {
+            "syncSource": [self.library.root],
+            "syncDestination": self.destination,
+            "cacheDirectory": self.cacheDirectory,
+            "runReport": REPORT
+        }
+        config.update(self.settings)
+        with open(self.configFile, "w") as f:
+            json.dump(config, f, indent=4)
+
+    def __sync(self, scenario, repeat):
+        """ Run main.py once, return (wall time, run report) """
+        logFile = os.path.join(self.logDirectory, "{}-{}.log".format(scenario, repeat))
+        startTime = time.perf_counter()
+        with open(logFile, "w") as log:
+            process = subprocess.run([sys.executable, MAIN, "-c", self.configFile],
+                                     stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        wall = time.perf_counter() - startTime
+        if process.returncode != 0:
+            raise RuntimeError("Sync failed during {}, see {}".format(scenario, logFile))
+        with open(os.path.join(self.destination, REPORT)) as f:
+            return wall, json.load(f)
+
+    def __prepare(self, scenario):
+        """ Bring the library and destination in the state scenario starts from """
+        base = self.shape.albums
+        incremental = range(base, base + self.INCREMENTAL_ALBUMS)
+        if scenario == "full":
+            self.library.removeAlbums(incremental)
+            for directory in (self.destination, self.cacheDirectory):
+                shutil.rmtree(directory, ignore_errors=True)
+        elif scenario == "add":
+            self.library.addAlbums(incremental)
+        elif scenario == "remove":
+            self.library.removeAlbums(incremental)
+
+    def run(self, repeat=1):
+        """ Run every scenario repeat times, keep the fastest run of each """
+        os.makedirs(self.logDirectory, exist_ok=True)
+        startTime = time.perf_counter()
+        if self.library.generate():
+            logging.info("Generated {} track(s) in {:.1f} s".format(self.library.trackCount(),
+                                                                    time.perf_counter() - startTime))
+        self.__writeConfig()
+        scenarios = {}
+        for attempt in range(repeat):
+            for scenario in SCENARIOS:
+                self.__prepare(scenario)
+                wall, report = self.__sync(scenario, attempt)
+                logging.info("{} (run {}/{}): {:.2f} s".format(scenario, attempt + 1, repeat, wall))
+                if scenario not in scenarios or wall < scenarios[scenario]["wall"]:
+                    scenarios[scenario] = {
+                        "wall": wall,
+                        "cpu": report["cpu"],
+                        "childrenCPU": report["childrenCPU"],
+                        "maxRSS": report["maxRSS"],
+                        "stages": report["stages"],
+                        "encodes": report["encodes"]
+                    }
+        return {
+            "version": self.VERSION,
+            "shape": self.shape.toDict(),
+            "settings": self.settings,
+            "tracks": self.library.trackCount(),
+            "python": platform.python_version(),
+            "ffmpeg": ffmpegVersion(),
+            "scenarios": scenarios
+        }
+
+
+def ffmpegVersion():
+    output = subprocess.check_output(["ffmpeg", "-version"], stderr=subprocess.DEVNULL)
+    return output.decode("utf-8").splitlines()[0]
+
+
+def compare(result, baseline, threshold=0.1, noise=0.05):
+    """ Log how result compares to baseline, return the list of regressions
+        Times below noise seconds in the baseline are shown but never count as regressions """
+    if baseline.get("shape") != result["shape"] or baseline.get("settings") != result["settings"]:
+        logging.warning("Baseline was made with a different library shape or settings, comparison is meaningless")
+    regressions = []
+    for scenario, current in result["scenarios"].items():
+        previous = baseline["scenarios"].get(scenario)
+        if previous is None:
+            continue
+        metrics = [("wall", previous["wall"], current["wall"])]
+        for stage, stats in sorted(current["stages"].items()):
+            if stage in previous["stages"]:
+                metrics.append((stage, previous["stages"][stage]["wall"], stats["wall"]))
+        for name, old, new in metrics:
+            ratio = new / old if old else float("inf")
+            regressed = old >= noise and ratio > 1 + threshold
+            logging.info("{:>7} {:<12} {:9.3f} s -> {:9.3f} s ({:+.1f}%){}".format(
+                scenario, name, old, new, (ratio - 1) * 100, " REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((scenario, name, ratio))
+        if previous.get("maxRSS") and current.get("maxRSS"):
+            ratio = current["maxRSS"] / previous["maxRSS"]
+            regressed = ratio > 1 + threshold
+            logging.info("{:>7} {:<12} {:7.1f} MiB -> {:7.1f} MiB ({:+.1f}%){}".format(
+                scenario, "maxRSS", previous["maxRSS"] / 2 ** 20, current["maxRSS"] / 2 ** 20, (ratio - 1) * 100,
+                " REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((scenario, "maxRSS", ratio))
+    return regressions
@@ -3,37 +3,124 @@
 import argparse
 import logging
 import os
+import signal
+import time
 
 import pyMusicSync
 
 
-def getConfigPath():
+def parseArgs():
     parser = argparse.ArgumentParser(description="Sync your music the hard way")
     parser.add_argument("-c", "--config", help="Specify config file path", default="./config.json")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--plan", metavar="FILE",
+                       help="Scan the library and save what would be done to FILE, without syncing")
+    group.add_argument("--execute", metavar="FILE",
+                       help="Run a plan saved with --plan, without scanning the library again")
+    group.add_argument("--watch", action="store_true",
+                       help="Keep running after the sync, and sync changes to the library as they happen")
+    group.add_argument("--query", action="store_true",
+                       help="Print the indexed tracks passing the configured filters, without scanning")
     args = parser.parse_args()
-    return args.config
+    # Paths are relative to where we were started, not to syncDestination
+    for key in ("plan", "execute"):
+        if getattr(args, key) is not None:
+            setattr(args, key, os.path.abspath(getattr(args, key)))
+    return args
 
 
-logging.basicConfig(format="[%(asctime)s][%(funcName)s] %(message)s",
-                    datefmt="%Y-%m-%d %H:%M:%S",
-                    level=logging.NOTSET)
+def query(config):
+    scanIndex = pyMusicSync.objects.ScanIndex(config.scanIndex)
+    try:
+        table = pyMusicSync.objects.TrackTable.fromScanIndex(scanIndex)
+    except ImportError as e:
+        logging.error(e)
+        return
+    finally:
+        scanIndex.close()
+    startTime = time.monotonic()
+    paths = table.select(config.filter)
+    logging.info("{} of {} indexed track(s) pass the filters ({:.1f} ms)"
+                 .format(len(paths), len(table), (time.monotonic() - startTime) * 1000))
+    for path in paths:
+        print(path)
 
-config = pyMusicSync.config.Config(getConfigPath())
 
-if not os.path.isdir(config.syncDestination):
-    os.mkdir(config.syncDestination)
+def interruptHandler(signum, frame):
+    raise KeyboardInterrupt("Received signal {}".format(signum))
 
-os.chdir(config.syncDestination)
 
-sync = pyMusicSync.sync.musicSync(config=config)
+def main():
+    logging.basicConfig(format="[%(asctime)s][%(funcName)s] %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S",
+                        level=logging.NOTSET)
 
-for folder in config.syncSource:
-    sync.folderTraversal(folder)
+    args = parseArgs()
+    config = pyMusicSync.config.Config(args.config)
 
-sync.prune()
+    if not os.path.isdir(config.syncDestination):
+        os.mkdir(config.syncDestination)
 
-sync.startSync()
+    os.chdir(config.syncDestination)
 
-sync.shutdown()
+    if args.query:
+        query(config)
+        return
 
-logging.shutdown()
+    sync = pyMusicSync.sync.musicSync(config=config)
+
+    signal.signal(signal.SIGTERM, interruptHandler)
+    signal.signal(signal.SIGHUP, interruptHandler)
+
+    try:
+        if args.execute is not None:
+            plans = pyMusicSync.planner.loadPlans(args.execute)
+            sync.summary(plans)
+            sync.executePlan(plans)
+        elif args.plan is not None or config.dryRun:
+            # Only build the plan, nothing is written to the destination
+            for folder in config.syncSource:
+                sync.folderTraversal(folder)
+            plans = sync.plan()
+            sync.summary(plans)
+            if args.plan is not None:
+                pyMusicSync.planner.savePlans(plans, args.plan)
+                logging.info("Plan saved to {}".format(args.plan))
+        else:
+            watcher = None
+            if args.watch:
+                watcher = pyMusicSync.watcher.createWatcher(config.syncSource, config.watchMethod,
+                                                            config.watchPollInterval)
+
+            # Encoding starts while the library is still being scanned
+            sync.startSync()
+
+            for folder in config.syncSource:
+                sync.folderTraversal(folder)
+
+            # Pruning needs the full list of tracks, so it has to wait for the scan,
+            # but not for the encoder
+            sync.prune()
+
+            if watcher is not None:
+                # Runs until interrupted, queued tracks are dropped then like on any interruption
+                pyMusicSync.watcher.watch(sync, config, watcher)
+
+            sync.finishSync()
+    except KeyboardInterrupt:
+        logging.info("Interrupted, saving progress")
+        sync.abort()
+    except BaseException:
+        # The lanes and the record autosave would keep the process alive otherwise
+        logging.error("Sync failed, saving progress")
+        sync.abort()
+        raise
+    else:
+        sync.shutdown()
+
+    logging.shutdown()
+
+
+# Guarded so the scanner's worker processes can import this module safely
+if __name__ == "__main__":
+    main()
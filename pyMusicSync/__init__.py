@@ -1,3 +1,6 @@
 import logging
 import pyMusicSync.config
 import pyMusicSync.sync
+import pyMusicSync.planner
+import pyMusicSync.watcher
+import pyMusicSync.objects
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Content-addressed file cache with LRU eviction
+# Files are stored as <directory>/<key[:2]>/<key><suffix>, their mtime is bumped
+# on every hit so the least recently used ones get evicted first, on later runs too
+# The cache directory is only walked once, when the cache is opened
+
+import collections
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+
+class FileCache:
+    # Evict down to this fraction of maxSize, so the following puts don't all evict again
+    EVICT_TARGET = 0.9
+
+    def __init__(self, directory, maxSize, suffix=""):
+        self.directory = os.path.expanduser(directory)
+        self.maxSize = maxSize
+        self.suffix = suffix
+        self.threadLock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        # <path>:<size>, least recently used first
+        self.index = collections.OrderedDict(
+            (path, size) for path, _, size in sorted(self.__entries(), key=lambda entry: entry[1]))
+        self.totalSize = sum(self.index.values())
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            digest.update(str(part).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def __entries(self):
+        """ Yield (path, mtime, size) of every cached file """
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith(".tmp_"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def __use(self, key):
+        """ Mark key as the most recently used entry, return its path or None """
+        path = self.__path(key)
+        with self.threadLock:
+            if path not in self.index:
+                self.misses += 1
+                return None
+            self.index.move_to_end(path)
+            self.hits += 1
+        return path
+
+    def __forget(self, path):
+        # The file is gone behind our back
+        with self.threadLock:
+            self.totalSize -= self.index.pop(path, 0)
+
+    def get(self, key):
+        """ Return the path of the cached file, or None """
+        path = self.__use(key)
+        if path is None:
+            return None
+        try:
+            # Keeps the order for the next runs
+            os.utime(path)
+        except FileNotFoundError:
+            self.__forget(path)
+            return None
+        return path
+
+    def link(self, key, dst):
+        """ Hard link the cached file to dst, which keeps it around even if it gets evicted
+            Falls back to a copy where hard links aren't supported, return False if key isn't cached """
+        path = self.__use(key)
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+            try:
+                os.link(path, dst)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                shutil.copyfile(path, dst)
+        except FileNotFoundError:
+            self.__forget(path)
+            return False
+        return True
+
+    def put(self, key, srcPath):
+        """ Copy srcPath into the cache, return the cached path """
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+        os.close(fd)
+        try:
+            shutil.copyfile(srcPath, tmpPath)
+            os.replace(tmpPath, path)
+        except OSError:
+            os.remove(tmpPath)
+            raise
+        size = os.path.getsize(path)
+        with self.threadLock:
+            # Overwriting an entry replaces its size
+            self.totalSize += size - self.index.pop(path, 0)
+            self.index[path] = size
+            overflow = self.totalSize > self.maxSize
+        if overflow:
+            self.evict()
+        return path
+
+    def evict(self):
+        """ Remove the least recently used files until the cache fits in EVICT_TARGET * maxSize
+            Only the index is updated under the lock, files are removed after """
+        victims = []
+        with self.threadLock:
+            while self.index and self.totalSize > self.maxSize * self.EVICT_TARGET:
+                path, size = self.index.popitem(last=False)
+                self.totalSize -= size
+                victims.append(path)
+        for path in victims:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        logging.debug("Evicted {} file(s) from {}".format(len(victims), self.directory))
+
+    def report(self):
+        logging.info("Cache {}: {} hit(s), {} miss(es), {:.1f} MiB used"
+                     .format(self.directory, self.hits, self.misses, self.totalSize / 2 ** 20))
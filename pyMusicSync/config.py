@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import copy
 import json
+import os
 
 from pyMusicSync import encoder, utils, filter, modifier, cover_art
 
@@ -11,18 +13,45 @@ class Config:
         "syncDestination"
     ]
     OPTIONAL_OPTIONS = {
-        "threadNum": 1,
+        "threadNum": None,  # Defaults to the number of idle CPUs
+        "ioThreadNum": 2,
+        "copyCompareHash": False,  # Hash files of equal size but different mtime before copying over them
+        "coverThreadNum": 2,
+        "maxQueuedJobs": 5000,
+        "scanThreadNum": None,  # Defaults to the number of CPUs
         "dryRun": False,
         "encoderSetting": {},  # EncoderSetting will handle this instead
         "autosaveInterval": 5,
+        "autosaveBatchSize": 100,
+        "scanIndex": "scan_index.db",
+        "trackIdentity": "metadata",  # Either "metadata" or "content"
+        "encodeRetries": 3,
+        "quarantineFile": "quarantine.json",
+        "runReport": "run_report.json",  # Per stage timings of the last run, None to disable
+        "progressOutput": "log",  # "log", "terminal" (a single updating line), "json" (into progressFile) or None
+        "progressInterval": 2,  # Seconds between progress reports
+        "progressFile": "progress.json",
+        "cacheDirectory": "~/.cache/pyMusicSync",
+        "coverCacheSize": 256,  # MiB
+        "transcodeCacheSize": 0,  # MiB of encoded tracks kept for the next runs, 0 to disable
+        "watchMethod": "auto",  # How --watch finds changes: "inotify", "poll", or "auto" to poll only without inotify
+        "watchDebounce": 3,  # Seconds without changes before they're synced
+        "watchMaxDelay": 60,  # Seconds a burst of changes can hold syncing back
+        "watchPollInterval": 30,  # Seconds between two listings of the sync sources when polling
         "filters": [],
         "modifiers": [],
-        "upscaleSetting": {} # Handled by UpscaleSetting
+        "upscaleSetting": {}, # Handled by UpscaleSetting
+        # More devices to sync to, e.g. [{"path": "/media/player", "encoderSetting": {...}}]
+        # Every entry can override DESTINATION_OPTIONS, the rest is shared with syncDestination
+        "destinations": []
     }
+    DESTINATION_OPTIONS = ["filters", "modifiers", "encoderSetting", "ioThreadNum"]
 
     def __init__(self, configFile):
         self.configFile = configFile
         self.read()
+        # main.py changes into syncDestination, destinations must not depend on where we were started
+        self.syncDestination = os.path.abspath(self.syncDestination)
         self.encoderSetting = encoder.EncoderSetting(self.encoderSetting)
         self.upscaleSetting = cover_art.UpscaleSetting(self.upscaleSetting)
         self.filter = filter.Filter(self.filters)
@@ -36,6 +65,24 @@ class Config:
         for key, default in self.OPTIONAL_OPTIONS.items():
             self.__setattr__(key, utils.getKey(data, key, default=default))
 
+    def destinationConfigs(self):
+        """ One Config per destination, starting with syncDestination itself """
+        configs = [self]
+        for options in self.destinations:
+            config = copy.copy(self)
+            config.syncDestination = os.path.abspath(utils.getKey(options, "path", raiseCheck=True))
+            for key in self.DESTINATION_OPTIONS:
+                if key in options:
+                    setattr(config, key, options[key])
+            if "encoderSetting" in options:
+                config.encoderSetting = encoder.EncoderSetting(config.encoderSetting)
+            if "filters" in options:
+                config.filter = filter.Filter(config.filters)
+            if "modifiers" in options:
+                config.modifier = modifier.Modifier(config.modifiers)
+            configs.append(config)
+        return configs
+
     def write(self):
         data = {}
         for key in self.REQUIRED_OPTIONS:
@@ -1,9 +1,11 @@
+import json
 import subprocess
 import os
 import tempfile
 import shutil
 import logging
 import math
+import threading
 from PIL import Image
 from . import utils
 
@@ -15,25 +17,27 @@ def PILResize(src, width, height, targetWidth, targetHeight):
     else:
         size = (targetWidth, math.ceil(targetWidth * aspect_ratio))
 
-    tmp = tempfile.mkstemp(suffix=".jpg", prefix="pmsync_cover_")
-    img = Image.open(src, "r")
-    img = img.resize(size, Image.LANCZOS)
+    fd, tmp = tempfile.mkstemp(suffix=".jpg", prefix="pmsync_cover_")
+    os.close(fd)
+    with Image.open(src, "r") as img:
+        img = img.resize(size, Image.LANCZOS)
     if img.mode == "P":
         img = img.convert(mode = "RGB")
-    img.save(tmp[1], "jpeg", quality=95, optimize=True)
-    return tmp[1]
+    img.save(tmp, "jpeg", quality=95, optimize=True)
+    return tmp
 
 
 def Waifu2xResize(src, width, height, targetWidth, targetHeight):
     resize_factor = 2 ** math.ceil(max(math.log2(targetHeight / height), math.log2(targetWidth / targetWidth)))
     logging.debug("w: {} h: {} tw: {} th: {} rf: {}".format(width, height, targetWidth, targetHeight, resize_factor))
-    tmp = tempfile.mkstemp(suffix=".png", prefix="pmsync_cover_")
+    fd, tmp = tempfile.mkstemp(suffix=".png", prefix="pmsync_cover_")
+    os.close(fd)
     try:
         subprocess.run(["waifu2x-converter-cpp",
                         "--scale_ratio", str(resize_factor),
                         "-m", "scale",
                         "-i", src,
-                        "-o", tmp[1]],
+                        "-o", tmp],
                        check=True,
                        stdin=subprocess.DEVNULL,
                        stdout=subprocess.PIPE,
@@ -44,8 +48,13 @@ def Waifu2xResize(src, width, height, targetWidth, targetHeight):
         logging.debug("output: {}".format(e.stdout.decode()))
         logging.debug("stderr: {}".format(e.stderr.decode()))
         logging.debug("=== CalledProcessError ===")
-        os.remove(tmp[1])
-    return PILResize(tmp[1], width*resize_factor, height*resize_factor, targetWidth, targetHeight)
+        os.remove(tmp)
+        # Fall back to PIL instead of resizing a missing file
+        return PILResize(src, width, height, targetWidth, targetHeight)
+    try:
+        return PILResize(tmp, width*resize_factor, height*resize_factor, targetWidth, targetHeight)
+    finally:
+        os.remove(tmp)
 
 class UpscaleSetting:
     # All cover art will be resize so that the aspect ratio stays the same
@@ -54,12 +63,15 @@ class UpscaleSetting:
         "engine": "PIL",
         "targetHeight": 720,
         "targetWidth": 1280,
-        "ignoreIfLarger": False
+        "ignoreIfLarger": False,
+        "waifu2xThreadNum": 1
     }
 
     def __init__(self, config):
         for key, default in self.OPTIONAL_OPTIONS.items():
             self.__setattr__(key, utils.getKey(config, key, default=default))
+        # waifu2x is heavy enough to saturate the CPU on its own, cap how many run at once
+        self.waifu2xLimit = threading.BoundedSemaphore(self.waifu2xThreadNum)
         if self.engine == "waifu2x":
             self.upscale = Waifu2xResize
             pass
@@ -77,24 +89,44 @@ class UpscaleSetting:
             result[key] = getattr(self, key)
         return result
 
+    def cacheKey(self):
+        """ Options that change the output image, as a stable string """
+        result = self.toDict()
+        del result["waifu2xThreadNum"]
+        return json.dumps(result, sort_keys=True)
+
 
-def copy_cover_art(src, dst, setting):
+def copy_cover_art(src, dst, setting, cache=None):
+    """ Copy the cover art src into the album directory dst, resizing it if needed
+        Resized images are looked up in and saved to cache, if there's one """
     try:
-        img = Image.open(src, "r")
+        with Image.open(src, "r") as img:
+            width, height = img.size
     except IOError:
         logging.debug("Error loading cover art {}, ignoring".format(src))
         return
-    width, height = img.size
-    if setting.enabled:
-        if (width >= setting.targetWidth) or (height >= setting.targetHeight):
-            if setting.ignoreIfLarger:
-                shutil.copy(src, dst)
-            else:
-                # Just downscale, PIL/Lanczos is enough
-                src = PILResize(src, width, height, setting.targetWidth, setting.targetHeight)
-                shutil.copy(src, os.path.join(dst, "cover.jpg"))
-        else:
-            src = setting.upscale(src, width, height, setting.targetWidth, setting.targetHeight)
-            shutil.copy(src, os.path.join(dst, "cover.jpg"))
-    else:
+    isLarger = (width >= setting.targetWidth) or (height >= setting.targetHeight)
+    if not setting.enabled or (isLarger and setting.ignoreIfLarger):
         shutil.copy(src, dst)
+        return
+    dst = os.path.join(dst, "cover.jpg")
+    if cache is not None:
+        key = cache.key(utils.hashFile(src), setting.cacheKey())
+        cached = cache.get(key)
+        if cached is not None:
+            shutil.copy(cached, dst)
+            return
+    if isLarger:
+        # Just downscale, PIL/Lanczos is enough
+        resized = PILResize(src, width, height, setting.targetWidth, setting.targetHeight)
+    elif setting.upscale is Waifu2xResize:
+        with setting.waifu2xLimit:
+            resized = setting.upscale(src, width, height, setting.targetWidth, setting.targetHeight)
+    else:
+        resized = setting.upscale(src, width, height, setting.targetWidth, setting.targetHeight)
+    try:
+        shutil.copy(resized, dst)
+        if cache is not None:
+            cache.put(key, resized)
+    finally:
+        os.remove(resized)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import shutil
+
+from pyMusicSync import encoder, objects, utils, cover_art, planner, timing
+
+
+class Destination:
+    """ Class representing a device the library is synced to
+        It has its own record, quarantine, filters, modifiers and encoder settings
+        Paths in the record are relative to root """
+    COVER_NAMES = ["cover_override.jpg", "cover.png", "cover.jpg", "folder.jpg",
+                   "Cover.jpg", "folder.jpeg", "cover.jpeg", "folder.png"]
+
+    def __init__(self, config, shared, checkPaths=False):
+        """ config is the Config of this destination, see Config.destinationConfigs()
+            shared holds what every destination uses: progress, copier and coverCache
+            checkPaths if the scanner didn't already apply this destination's path filters """
+        self.config = config
+        self.checkPaths = checkPaths
+        self.root = os.path.abspath(config.syncDestination)
+        # Scheduler lane writing to this device, so every device gets its own I/O concurrency
+        self.lane = "copy:{}".format(self.root)
+        self.progress = shared.progress
+        self.copier = shared.copier
+        self.coverCache = shared.coverCache
+        if not os.path.isdir(self.root):
+            os.mkdir(self.root)
+        self.record = objects.Record(self.path("record.json"), config.autosaveInterval, config.autosaveBatchSize)
+        self.quarantine = objects.Quarantine(self.path(config.quarantineFile))
+        self.destinationIndex = objects.DestinationIndex()
+        # Records made with an older ID version are rekeyed as their tracks are scanned
+        self.migrateIDs = (self.record.idVersion < utils.ID_VERSION)
+        self.albums = {}  # <albumName>:<Album>, tracks waiting to be synced
+        self.moves = []  # [(<Album>, <Track>, <old path>)], waiting for startSync()
+        self.initializedAlbums = set()
+        # Submitted but not synced yet, so a track scanned again meanwhile isn't synced twice
+        self.inFlight = set()
+        # ID of every scanned track this destination's filters accept, synced tracks missing from it get pruned
+        self.wanted = set()
+        self.scheduler = None  # Set by musicSync while syncing
+        self.record.startAutosave()
+
+    def path(self, relativePath):
+        return os.path.join(self.root, relativePath)
+
+    def classify(self, scanned, newTracks, movedTracks):
+        """ Sort the [(<full path>, <Metadata>, <trackID>)] of a directory into newTracks, if they need syncing,
+            and movedTracks, if their tags changed since
+            Tracks rejected by the filters are left out of wanted, quarantined ones are only skipped """
+        # One sample per directory, not per track
+        with timing.timer.measure("filtering"):
+            accepted = [self.config.filter.check(metadata) and self.__checkPath(fullPath)
+                        for fullPath, metadata, _ in scanned]
+        for (fullPath, metadata, trackID), isAccepted in zip(scanned, accepted):
+            if not isAccepted:
+                # Its tags may have changed since it was synced
+                self.wanted.discard(trackID)
+                continue
+            self.wanted.add(trackID)
+            self.__classifyTrack(fullPath, metadata, trackID, newTracks, movedTracks)
+
+    def __classifyTrack(self, fullPath, metadata, trackID, newTracks, movedTracks):
+        if self.migrateIDs and trackID not in self.record:
+            legacyID = utils.genLegacyID(metadata, self.config.trackIdentity, self.record.idVersion)
+            if legacyID is not None and legacyID in self.record:
+                self.record.rekey(legacyID, trackID)
+        if trackID in self.inFlight:
+            return
+        if fullPath in self.quarantine:
+            logging.debug("Skipping quarantined track {}".format(fullPath))
+            return
+        # The ID comes from the original tags, so changing modifiers moves tracks instead of re-encoding
+        metadata = self.config.modifier.apply(metadata)
+        track = objects.Track(metadata, fullPath, trackID)
+        if trackID in self.record:
+            if self.__hasMoved(track):
+                movedTracks.setdefault(metadata.album, []).append(track)
+        else:
+            self.inFlight.add(trackID)
+            newTracks.setdefault(metadata.album, []).append(track)
+            self.progress.incTotal(track.duration)
+
+    def __checkPath(self, fullPath):
+        if not self.checkPaths or self.config.filter.pathPredicate is None:
+            return True
+        return self.config.filter.checkPath(fullPath, os.stat(fullPath))
+
+    def addTracks(self, root, coverFile, newTracks, movedTracks):
+        """ Group the tracks found in root by album, move tracks right away if syncing has started
+            Return [(<Destination>, <Album>, [<Track>])] of the new tracks to submit """
+        batch = []
+        for albumName in set(newTracks) | set(movedTracks):
+            directory = self.albumDirectory(albumName, root)
+            if directory not in self.albums:
+                self.albums[directory] = objects.Album(albumName, directory)
+            album = self.albums[directory]
+            if coverFile is not None:
+                album.coverFile = coverFile
+            for track in movedTracks.get(albumName, []):
+                if self.scheduler is not None:
+                    self.moveTrack(album, track)
+                else:
+                    self.moves.append((album, track, self.record.get(track.trackID)))
+            tracks = newTracks.get(albumName, [])
+            if not tracks:
+                continue
+            for track in tracks:
+                album.add(track)
+                # Keep prune() from removing the folder until the track is synced
+                self.destinationIndex.reserve(self.__trackDirectory(track))
+            logging.info("Album: %s with %d song(s) for %s" % (albumName, len(album.tracks), self.root))
+            batch.append((self, album, tracks))
+        return batch
+
+    def __hasMoved(self, track):
+        oldPath = self.record.get(track.trackID)
+        return self.getFilePath(track, ext=os.path.splitext(oldPath)[1]) != oldPath
+
+    def moveTrack(self, album, track):
+        """ Move an already synced track to where its current tags say it belongs,
+            instead of re-encoding it under a new name """
+        if track.trackID not in self.record:
+            logging.warning("Track {} isn't synced anymore, not moving it".format(track.filePath))
+            return
+        oldPath = self.record.get(track.trackID)
+        track.syncedFilePath = self.getFilePath(track, ext=os.path.splitext(oldPath)[1])
+        logging.info("Moving track {} => {} in {}".format(oldPath, track.syncedFilePath, self.root))
+        if self.config.dryRun:
+            return
+        if not os.path.isfile(self.path(oldPath)):
+            logging.warning("Synced track {} is missing, not moving it".format(self.path(oldPath)))
+            return
+        self.initAlbum(album)
+        os.replace(self.path(oldPath), self.path(track.syncedFilePath))
+        self.destinationIndex.add(self.path(track.syncedFilePath))
+        self.destinationIndex.remove(self.path(oldPath))
+        self.record.add(track)
+        self.__removeIfEmpty(os.path.split(oldPath)[0])
+
+    def encodeTrack(self, track):
+        """ Encode track straight into this destination, return the absolute path of the result
+            EncodeError is left to the caller, see fail() """
+        filePath = self.getFilePath(track)
+        output = encoder.encode(track.filePath, self.path(filePath), self.config.encoderSetting,
+                                self.config.encodeRetries, duration=track.duration)
+        track.syncedFilePath = filePath + self.config.encoderSetting.ext
+        self.__done(track)
+        return output
+
+    def copyTrack(self, track, source=None):
+        """ Copy a lossy track as is, or source, a staged encode of track with this destination's encoder output """
+        if self.config.dryRun:
+            self.__done(track)
+            return
+        if source is None:
+            track.syncedFilePath = self.getFilePath(track, ext=os.path.splitext(track.filePath)[1])
+            source = track.filePath
+        else:
+            track.syncedFilePath = self.getFilePath(track, ext=self.config.encoderSetting.ext)
+        self.copier.copy(source, self.path(track.syncedFilePath))
+        self.__done(track)
+
+    def fail(self, track, error):
+        self.quarantine.add(track.filePath, error)
+        self.__finish(track)
+
+    def skip(self, track, error):
+        """ Give up on track for this run without quarantining it, the source isn't to blame """
+        logging.error("Unable to sync {} to {}: {}".format(track.filePath, self.root, error))
+        self.__finish(track)
+
+    def __done(self, track):
+        if track.syncedFilePath is not None:
+            self.destinationIndex.add(self.path(track.syncedFilePath))
+            self.record.add(track)
+        self.__finish(track)
+        logging.debug("Processed track {} for {}".format(track.title, self.root))
+
+    def __finish(self, track):
+        # Whether it was synced or not, the folder of its album may be pruned now
+        self.destinationIndex.release(self.__trackDirectory(track))
+        self.inFlight.discard(track.trackID)
+        self.progress.increase(track.duration)
+
+    def __trackDirectory(self, track):
+        return self.path(self.albumDirectory(track.album, os.path.dirname(track.filePath)))
+
+    def __createAlbumDirectory(self, album):
+        dirName = album.directory
+        logging.info("Sanitized album folder name: {} => {}".format(album.title, dirName))
+        if not os.path.isdir(self.path(dirName)):
+            os.mkdir(self.path(dirName))
+        if album.coverFile is None:
+            return
+        if self.scheduler is not None:
+            # Cover art has its own lane, tracks of this album don't wait for it
+            self.scheduler.submit("cover", 0, self.__copyCover, album.coverFile, self.path(dirName))
+        else:
+            self.__copyCover(album.coverFile, self.path(dirName))
+
+    def __copyCover(self, coverFile, directory):
+        with timing.timer.measure("cover", bytesIn=os.path.getsize(coverFile)):
+            cover_art.copy_cover_art(coverFile, directory, self.config.upscaleSetting, self.coverCache)
+
+    def initAlbum(self, album):
+        if album.directory not in self.initializedAlbums:
+            logging.info("Initializing album {} in {}".format(album.title, self.root))
+            self.__createAlbumDirectory(album)
+            self.initializedAlbums.add(album.directory)
+
+    def startMoves(self):
+        """ Run the moves found before syncing started """
+        for album, track, _ in self.moves:
+            self.moveTrack(album, track)
+        self.moves = []
+
+    def __removeIfEmpty(self, fileDir):
+        """ Remove fileDir if nothing but cover art is left in it """
+        if self.destinationIndex.isEmpty(self.path(fileDir), self.COVER_NAMES):
+            logging.info("Removing empty folder {}".format(self.path(fileDir)))
+            shutil.rmtree(self.path(fileDir))
+            self.destinationIndex.forget(self.path(fileDir))
+            # Created again if the album comes back, in watch mode
+            self.initializedAlbums.discard(fileDir)
+
+    def staleTracks(self, trackIDs=None):
+        """ (<trackID>, <path>) of every synced track that isn't wanted, out of trackIDs if given """
+        if trackIDs is None:
+            stale = self.record.difference(self.wanted)
+        else:
+            stale = [trackID for trackID in trackIDs if trackID in self.record and trackID not in self.wanted]
+        return [(trackID, self.record.get(trackID)) for trackID in stale]
+
+    def prune(self, deletes):
+        """ Remove stale tracks, one directory at a time
+            Safe to call while tracks are being synced, their folders are never removed """
+        deletes = [(trackID, path) for trackID, path in deletes if trackID in self.record]
+        if not deletes:
+            return
+        # A track with the same tags but new audio gets a new ID and is synced to the same path, keep its file
+        kept = self.record.paths({trackID for trackID, _ in deletes})
+        byDirectory = {}  # <directory>:[(<trackID>, <path>)]
+        for trackID, path in deletes:
+            byDirectory.setdefault(os.path.split(path)[0], []).append((trackID, path))
+        for directory, entries in byDirectory.items():
+            logging.info("Removing {} old track(s) from {}".format(len(entries), self.path(directory)))
+            for trackID, path in entries:
+                if path in kept:
+                    continue
+                try:
+                    os.remove(self.path(path))
+                except FileNotFoundError:
+                    logging.warning("{} is already gone".format(self.path(path)))
+                self.destinationIndex.remove(self.path(path))
+            self.record.removeMany([trackID for trackID, _ in entries])
+            if os.path.isdir(self.path(directory)):
+                self.__removeIfEmpty(directory)
+
+    def plan(self):
+        return planner.SyncPlan(list(self.albums.values()), list(self.moves), self.staleTracks(),
+                                self.root)
+
+    def loadPlan(self, plan):
+        for album in plan.albums:
+            self.albums[album.directory] = album
+            for track in album.tracks:
+                self.destinationIndex.reserve(self.__trackDirectory(track))
+                self.progress.incTotal(track.duration)
+        self.moves.extend(plan.moves)
+
+    def abort(self):
+        self.record.killAutosave()
+        self.record.close()
+        self.quarantine.write()
+
+    def shutdown(self, scanned):
+        self.record.killAutosave()
+        # After a full scan, entries still under an old ID belong to tracks that are gone
+        if scanned and self.migrateIDs:
+            self.record.setIDVersion(utils.ID_VERSION)
+        self.record.close()
+        self.quarantine.write()
+        self.quarantine.summary()
+
+    @staticmethod
+    def albumDirectory(albumName, sourceDirectory):
+        """ Folder of an album on the destination, untitled albums get one per source directory """
+        return utils.pathSanitize(albumName, sourceDirectory)
+
+    @staticmethod
+    def getFilePath(track, ext=""):
+        directory = Destination.albumDirectory(track.album, os.path.dirname(track.filePath))
+        if track.trackNumber is None:
+            filename = "{title}{ext}"
+        else:
+            filename = "{trackNum:02d}. {title}{ext}"
+        filename = filename.format(trackNum=track.trackNumber, title=utils.pathSanitize(track.title, track.filePath),
+                                   ext=ext)
+
+        return os.path.join(directory, filename)
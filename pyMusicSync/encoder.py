@@ -1,20 +1,45 @@
 #!/usr/bin/env python3
 
+import functools
 import os
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import logging
 
-from pyMusicSync import utils
+from pyMusicSync import utils, timing, cache
 
 
 class EncoderSetting:
     OPTIONAL_OPTIONS = {
         "codec": "mp3",
         "bitrateControl": "vbr",
-        "quality": "0"
+        "quality": "0",
+        # "destination": encode into a temporary file next to the target, then rename it
+        # "pipe": same, but FFmpeg's output is piped through writeBuffer sized writes,
+        #         except for VBR MP3 which falls back to "destination", see __init__()
+        # "tmp": encode into the system temporary directory, then move it to the target
+        # The target is the destination, or a staging folder in cacheDirectory for encodes
+        # shared by several destinations, which is then copied to each of them
+        "writeMode": "destination",
+        "writeBuffer": 1024 * 1024
     }
+    # FFmpeg muxer to use when piping, by extension
+    PIPE_FORMATS = {
+        ".mp3": "mp3",
+        ".ogg": "ogg"
+    }
+    # Rough single-thread encoding speed (x realtime), only used for estimates
+    ENCODE_SPEED = {
+        "mp3": 40,
+        "opus": 60,
+        "vorbis": 40,
+        "aac": 50
+    }
+    # Approximate average bitrate (kbps) of LAME's VBR presets, -q:a 0 to 9
+    MP3_VBR_BITRATE = [245, 225, 190, 175, 165, 130, 115, 100, 85, 65]
 
     def __init__(self, config):
         codecMap = {
@@ -26,6 +51,11 @@ class EncoderSetting:
         for key, default in self.OPTIONAL_OPTIONS.items():
             self.__setattr__(key, utils.getKey(config, key, default=default))
         self.encoder, self.ext = codecMap[self.codec]
+        if self.writeMode == "pipe" and self.codec == "mp3" and self.bitrateControl == "vbr":
+            # FFmpeg only writes the Xing header to seekable outputs,
+            # without it players get the length of VBR MP3s wrong and can't seek in them
+            logging.warning("VBR MP3 can't be piped, writing it with writeMode \"destination\" instead")
+            self.writeMode = "destination"
 
     def toDict(self):
         result = {}
@@ -33,6 +63,20 @@ class EncoderSetting:
             result[key] = getattr(self, key)
         return result
 
+    def outputKey(self):
+        """ Settings that change the encoded file, writeMode and writeBuffer only change how it's written """
+        return (self.codec, self.bitrateControl, str(self.quality))
+
+    def estimatedBitrate(self):
+        """ Average output bitrate in kbps, a guess for VBR """
+        if self.bitrateControl == "cbr":
+            return float(self.quality)
+        if self.codec == "mp3":
+            return self.MP3_VBR_BITRATE[min(9, max(0, int(float(self.quality))))]
+        if self.codec == "vorbis":
+            return 64 + 32 * float(self.quality)
+        return 160
+
     @staticmethod
     def detect_fdkaac():
         ffmpegOutput = subprocess.check_output(
@@ -47,34 +91,128 @@ class EncoderSetting:
             return "aac"
 
 
-def encode(src, dst, setting):
-    tmpFile = tempfile.mkstemp(suffix=setting.ext, prefix="pmsync_")[1]
+@functools.lru_cache(maxsize=None)
+def ffmpegVersion():
+    """ First line of `ffmpeg -version` """
+    output = subprocess.check_output(["ffmpeg", "-version"], stderr=subprocess.DEVNULL)
+    return output.decode("utf-8").splitlines()[0]
+
+
+def cacheKey(src, setting):
+    """ Transcode cache key of src encoded with setting
+        The whole file is hashed, tags included since FFmpeg copies them into the output """
+    return cache.FileCache.key(utils.hashFile(src), setting.encoder, *setting.outputKey(), ffmpegVersion())
+
+
+class EncodeError(Exception):
+    """ Raised when FFmpeg keeps failing on a file """
+
+    def __init__(self, src, stderr):
+        super().__init__("Unable to encode {}: {}".format(src, stderr))
+        self.src = src
+        self.stderr = stderr
+
+
+class EncodeAborted(Exception):
+    """ Raised when FFmpeg was killed by a signal, which says nothing about the file """
+
+    def __init__(self, src, signal):
+        super().__init__("Encoding {} was interrupted by signal {}".format(src, signal))
+        self.src = src
+        self.signal = signal
+
+
+def _runFFmpeg(param, tmpFile):
+    subprocess.run(param + [tmpFile],
+                   check=True,
+                   stdin=subprocess.DEVNULL,
+                   stdout=subprocess.PIPE,
+                   stderr=subprocess.PIPE)
+
+
+def _pipeFFmpeg(param, tmpFile, muxer, writeBuffer):
+    """ Let FFmpeg write to stdout, and copy that into tmpFile writeBuffer bytes at a time """
+    with open(tmpFile, "wb", buffering=writeBuffer) as f:
+        process = subprocess.Popen(param + ["-f", muxer, "pipe:1"],
+                                   stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        # Drain stderr in the background, FFmpeg would block on a full pipe otherwise
+        stderr = []
+        stderrThread = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+        stderrThread.start()
+        shutil.copyfileobj(process.stdout, f, writeBuffer)
+        process.wait()
+        stderrThread.join()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args, b"", stderr[0])
+
+
+def _commit(tmpFile, dst):
+    """ Make sure tmpFile is on disk before it replaces dst, a crash never leaves a partial track behind """
+    with open(tmpFile, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmpFile, dst)
+
+
+def encode(src, dst, setting, retries=3, backoff=1.0, duration=None):
+    """ Encode src into dst + setting.ext
+        FFmpeg gets retries more attempts, waiting backoff, 2*backoff, 4*backoff... seconds
+        in between, before EncodeError is raised. EncodeAborted is raised right away if it's killed
+        duration (seconds of audio in src) is only used for the run report """
     dst = dst + setting.ext
+    muxer = setting.PIPE_FORMATS.get(setting.ext)
+    # MP4 can't be written to a pipe
+    usePipe = (setting.writeMode == "pipe" and muxer is not None)
 
     param = ["ffmpeg", "-v", "warning", "-i", src, "-vn", "-c:a", setting.encoder]
     if setting.bitrateControl == "vbr":
         param.extend(["-q:a", setting.quality])
     elif setting.bitrateControl == "cbr":
         param.extend(["-b:a", "{}k".format(setting.quality)])
-    param.extend(["-threads", "1", "-y", tmpFile])
-    success = False
+    param.extend(["-threads", "1", "-y"])
 
-    while not success:
+    for attempt in range(retries + 1):
+        if setting.writeMode == "tmp":
+            fd, tmpFile = tempfile.mkstemp(suffix=setting.ext, prefix="pmsync_")
+        else:
+            # Same filesystem as dst, so the final rename doesn't copy anything
+            fd, tmpFile = tempfile.mkstemp(suffix=setting.ext, prefix=".pmsync_",
+                                           dir=os.path.dirname(dst) or ".")
+        os.close(fd)
+        committed = False
         try:
-            subprocess.run(param,
-                           check=True,
-                           stdin=subprocess.DEVNULL,
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE)
+            with timing.timer.measure("ffmpeg", bytesIn=os.path.getsize(src)) as sample:
+                startTime = time.perf_counter()
+                if usePipe:
+                    _pipeFFmpeg(param, tmpFile, muxer, setting.writeBuffer)
+                else:
+                    _runFFmpeg(param, tmpFile)
+                sample.bytesOut = os.path.getsize(tmpFile)
+            timing.timer.addEncode(setting.codec, duration, time.perf_counter() - startTime)
+            if setting.writeMode == "tmp":
+                shutil.move(tmpFile, dst)
+            else:
+                _commit(tmpFile, dst)
+            committed = True
+            return dst
         except subprocess.CalledProcessError as e:
             logging.debug("=== CalledProcessError ===")
             logging.debug("cmd: {}".format(e.cmd))
             logging.debug("output: {}".format(e.stdout.decode()))
             logging.debug("stderr: {}".format(e.stderr.decode()))
             logging.debug("=== CalledProcessError ===")
-            os.remove(tmpFile)
-        else:
-            shutil.move(tmpFile, dst)
-            success = True
-
-    return dst
+            # Interrupted or killed (OOM killer...), neither retrying nor quarantining helps
+            if e.returncode < 0:
+                raise EncodeAborted(src, -e.returncode)
+            if attempt == retries:
+                raise EncodeError(src, e.stderr.decode().strip())
+        finally:
+            # Whatever went wrong, including in the commit, no partial file is left behind
+            if not committed:
+                try:
+                    os.remove(tmpFile)
+                except FileNotFoundError:
+                    pass
+        logging.info("Encoding {} failed, retrying ({}/{})".format(src, attempt + 1, retries))
+        time.sleep(backoff * (2 ** attempt))
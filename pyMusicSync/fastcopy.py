@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# File copies that avoid moving bytes through Python when the kernel can do better
+# Methods are tried in order: copy_file_range, reflink (FICLONE), sendfile, read/write
+# The first one that works is remembered per (source device, destination device)
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from pyMusicSync import utils, timing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# FICLONE from linux/fs.h
+FICLONE = 0x40049409
+# Errors meaning "this method isn't supported here", anything else is a real error
+UNSUPPORTED_ERRNO = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                     errno.EBADF, errno.EPERM, errno.ETXTBSY}
+
+
+def _copyFileRange(src, dst, size):
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src, dst, size - copied)
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+
+def _reflink(src, dst, size):
+    fcntl.ioctl(dst, FICLONE, src)
+    return size
+
+
+def _sendfile(src, dst, size):
+    copied = 0
+    while copied < size:
+        count = os.sendfile(dst, src, copied, size - copied)
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+
+def _readWrite(src, dst, size):
+    copied = 0
+    with open(src, "rb", closefd=False) as fsrc, open(dst, "wb", closefd=False) as fdst:
+        while True:
+            buffer = fsrc.read(1024 * 1024)
+            if not buffer:
+                break
+            fdst.write(buffer)
+            copied += len(buffer)
+    return copied
+
+
+METHODS = []
+if hasattr(os, "copy_file_range"):
+    METHODS.append(("copy_file_range", _copyFileRange))
+if fcntl is not None:
+    METHODS.append(("reflink", _reflink))
+if hasattr(os, "sendfile"):
+    METHODS.append(("sendfile", _sendfile))
+METHODS.append(("read/write", _readWrite))
+
+
+class CopyStats:
+    """ Per method counters, for the end of run summary """
+
+    def __init__(self):
+        self.threadLock = threading.Lock()
+        self.methods = {}  # <method>:[<files>, <bytes>, <seconds>]
+        self.skipped = 0
+
+    def add(self, method, size, elapsed):
+        with self.threadLock:
+            entry = self.methods.setdefault(method, [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += size
+            entry[2] += elapsed
+
+    def skip(self):
+        with self.threadLock:
+            self.skipped += 1
+
+    def report(self):
+        for method, (files, size, elapsed) in sorted(self.methods.items()):
+            logging.info("Copied {} file(s), {:.1f} MiB with {} ({:.1f} MiB/s)"
+                         .format(files, size / 2 ** 20, method, size / 2 ** 20 / elapsed if elapsed else 0))
+        if self.skipped:
+            logging.info("Skipped {} file(s) already up to date at the destination".format(self.skipped))
+
+
+class FastCopier:
+    def __init__(self, compareHash=False):
+        self.compareHash = compareHash
+        self.stats = CopyStats()
+        self.threadLock = threading.Lock()
+        self.preferred = {}  # (<source st_dev>, <destination st_dev>):<index in METHODS>
+
+    def __isUpToDate(self, src, srcStat, dst):
+        try:
+            dstStat = os.stat(dst)
+        except FileNotFoundError:
+            return False
+        if dstStat.st_size != srcStat.st_size:
+            return False
+        if dstStat.st_mtime_ns == srcStat.st_mtime_ns:
+            return True
+        if self.compareHash and utils.hashFile(src) == utils.hashFile(dst):
+            # Same content, only bring the times in line so the next check is cheap
+            shutil.copystat(src, dst)
+            return True
+        return False
+
+    def copy(self, src, dst):
+        """ Copy src to dst along with its mode and times, return the method used or None if skipped """
+        srcStat = os.stat(src)
+        if self.__isUpToDate(src, srcStat, dst):
+            self.stats.skip()
+            return None
+        directory = os.path.dirname(dst) or "."
+        key = (srcStat.st_dev, os.stat(directory).st_dev)
+        with self.threadLock:
+            first = self.preferred.get(key, 0)
+        fd, tmpFile = tempfile.mkstemp(prefix=".pmsync_", dir=directory)
+        try:
+            startTime = time.monotonic()
+            with timing.timer.measure("copy", bytesIn=srcStat.st_size) as sample:
+                with open(src, "rb") as fsrc:
+                    method = self.__copyData(fsrc.fileno(), fd, srcStat.st_size, key, first)
+                os.fsync(fd)
+                os.close(fd)
+                fd = None
+                shutil.copystat(src, tmpFile)
+                os.replace(tmpFile, dst)
+                sample.bytesOut = srcStat.st_size
+            self.stats.add(method, srcStat.st_size, time.monotonic() - startTime)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            os.remove(tmpFile)
+            raise
+        return method
+
+    def __copyData(self, src, dst, size, key, first):
+        """ A method counts as failed unless it copied exactly size bytes, the file may have changed meanwhile """
+        for index in range(first, len(METHODS)):
+            method, function = METHODS[index]
+            # A failed method may have moved the source offset too
+            os.lseek(src, 0, os.SEEK_SET)
+            try:
+                copied = function(src, dst, size)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNO:
+                    raise
+                copied = -1
+            if copied == size:
+                with self.threadLock:
+                    self.preferred[key] = index
+                return method
+            # Start over with the next method
+            os.ftruncate(dst, 0)
+            os.lseek(dst, 0, os.SEEK_SET)
+        raise OSError("Unable to copy {} bytes, or the source changed size".format(size))
@@ -1,13 +1,40 @@
 #!/usr/bin/env python3
 
 # A simple (right?) filter
-# Only supports AND (aka all FilterRule must return True)
+# Every top-level rule must match (AND), rules can be grouped with
+# {"any": [...]} (OR), {"all": [...]} (AND) and {"not": {...}}
+# Rules are compiled into plain closures once, and cheap rules run before regexes
+# Rules on path, filename, extension or size are checked before the tags are parsed
 
+import os
 import re
 
 
+def toNumber(value):
+    """ Tags like year can be "2001-05-01", compare on the leading number """
+    if isinstance(value, (int, float)) or value is None:
+        return value
+    match = re.match(r"\s*(-?\d+(?:\.\d+)?)", str(value))
+    return float(match.group(1)) if match else None
+
+
 class FilterRule:
+    # Relative cost of every operator, cheapest rules are checked first
+    OPERATORS = {
+        "==": 1,
+        "!=": 1,
+        "in": 2,
+        "<": 2,
+        "<=": 2,
+        ">": 2,
+        ">=": 2,
+        "range": 2,
+        "regex": 10
+    }
+
     def __init__(self, field, operator, value, applyNot=False):
+        if operator not in self.OPERATORS:
+            raise NotImplementedError("Unimplemented operator: {}".format(operator))
         self.field = field
         self.operator = operator
         if self.operator == "regex":
@@ -15,41 +42,154 @@ class FilterRule:
         else:
             self.value = value
         self.applyNot = applyNot
+        self.cost = self.OPERATORS[operator]
+        self.predicate = self.compile()
 
-    def apply(self, metadata):
-        fieldValue = getattr(metadata, self.field)
-        result = None
+    def comparator(self):
+        """ Return a function testing a single field value, applyNot is left to the caller """
+        value = self.value
         if self.operator == "regex":
-            if re.search(self.value, fieldValue) is None:
-                result = False
-            else:
-                result = True
-        elif self.operator == "<=":
-            result = (fieldValue <= self.value)
-        elif self.operator == "==":
-            result = (fieldValue == self.value)
-        elif self.operator == "in":
-            result = (fieldValue in self.value)
+            search = value.search
+            return lambda fieldValue: fieldValue is not None and search(str(fieldValue)) is not None
+        if self.operator == "==":
+            return lambda fieldValue: fieldValue == value
+        if self.operator == "!=":
+            return lambda fieldValue: fieldValue != value
+        if self.operator == "in":
+            return lambda fieldValue: fieldValue in value
+        if self.operator == "range":
+            low, high = value
+            return lambda fieldValue: _inRange(toNumber(fieldValue), low, high)
+        compare = {
+            "<": lambda a, b: a < b,
+            "<=": lambda a, b: a <= b,
+            ">": lambda a, b: a > b,
+            ">=": lambda a, b: a >= b
+        }[self.operator]
+        if self.isNumeric():
+            # Numeric rule on bitrate, duration, year...
+            return lambda fieldValue: _compareNumber(compare, toNumber(fieldValue), value)
+        return lambda fieldValue: compare(fieldValue, value)
+
+    def isNumeric(self):
+        """ True if the field is compared as a number, see toNumber() """
+        return self.operator == "range" or \
+            (self.operator in ("<", "<=", ">", ">=") and isinstance(self.value, (int, float)))
+
+    def compile(self):
+        field = self.field
+        compare = self.comparator()
+        if self.applyNot:
+            return lambda metadata: not compare(getattr(metadata, field))
+        return lambda metadata: compare(getattr(metadata, field))
+
+    def fields(self):
+        return {self.field}
+
+    def apply(self, metadata):
+        return self.predicate(metadata)
+
+
+def _inRange(number, low, high):
+    return number is not None and low <= number <= high
+
+
+def _compareNumber(compare, number, value):
+    return number is not None and compare(number, value)
+
+
+class FilterGroup:
+    """ Matches if all (mode "all") or any (mode "any") of its rules match """
+
+    def __init__(self, mode, rules, applyNot=False):
+        if mode not in ("all", "any"):
+            raise NotImplementedError("Unimplemented group: {}".format(mode))
+        self.mode = mode
+        self.rules = sorted(rules, key=lambda rule: rule.cost)
+        self.applyNot = applyNot
+        self.cost = sum(rule.cost for rule in self.rules)
+        self.predicate = self.compile()
+
+    def compile(self):
+        predicates = tuple(rule.predicate for rule in self.rules)
+        if len(predicates) == 1:
+            matches = predicates[0]
+        elif self.mode == "all":
+            def matches(metadata):
+                for predicate in predicates:
+                    if not predicate(metadata):
+                        return False
+                return True
         else:
-            raise NotImplementedError("Unimplemented operator: {}".format(self.operator))
-        return result ^ self.applyNot
+            def matches(metadata):
+                for predicate in predicates:
+                    if predicate(metadata):
+                        return True
+                return False
+        if self.applyNot:
+            return lambda metadata: not matches(metadata)
+        return matches
+
+    def fields(self):
+        return set().union(*(rule.fields() for rule in self.rules))
+
+    def apply(self, metadata):
+        return self.predicate(metadata)
+
+
+class PathInfo:
+    """ What's known about a file before its tags are parsed """
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.extension = os.path.splitext(path)[1].lower()
+        self.size = stat.st_size
 
 
 class Filter:
-    rules = []
+    PATH_FIELDS = {"path", "filename", "extension", "size"}
 
     def __init__(self, filterRules=None):
         if filterRules is None:
             filterRules = []
+        self.rules = []
+        self.pathRules = []
         for rule in filterRules:
-            self.addRule(**rule)
-        pass
+            self.add(self.parseRule(rule))
+        self.compile()
+
+    @classmethod
+    def parseRule(cls, rule):
+        """ Build a FilterRule or FilterGroup out of its config """
+        if "all" in rule or "any" in rule:
+            mode = "all" if "all" in rule else "any"
+            return FilterGroup(mode, [cls.parseRule(child) for child in rule[mode]],
+                               rule.get("applyNot", False))
+        if "not" in rule:
+            return FilterGroup("all", [cls.parseRule(rule["not"])], applyNot=True)
+        return FilterRule(**rule)
+
+    def add(self, rule):
+        fields = rule.fields()
+        if fields <= self.PATH_FIELDS:
+            self.pathRules.append(rule)
+        elif fields & self.PATH_FIELDS:
+            raise ValueError("Rules on {} can't be mixed with tag rules".format(", ".join(sorted(self.PATH_FIELDS))))
+        else:
+            self.rules.append(rule)
 
     def addRule(self, field, operator, value, applyNot=False):
-        self.rules.append(FilterRule(field, operator, value, applyNot))
+        self.add(FilterRule(field, operator, value, applyNot))
+        self.compile()
+
+    def compile(self):
+        self.predicate = FilterGroup("all", self.rules).predicate if self.rules else None
+        self.pathPredicate = FilterGroup("all", self.pathRules).predicate if self.pathRules else None
+
+    def checkPath(self, path, stat):
+        """ Check the rules that don't need the tags """
+        return self.pathPredicate is None or self.pathPredicate(PathInfo(path, stat))
 
     def check(self, metadata):
-        for rule in self.rules:
-            if not rule.apply(metadata):
-                return False
-        return True
+        return self.predicate is None or self.predicate(metadata)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# A cheap audio fingerprint that survives retagging
+# Only the first and last few KiB of the audio stream are hashed, tag blocks
+# at the start (ID3v2, FLAC metadata) and end (ID3v1, APEv2) of the file are skipped
+# Other containers (Ogg, MP4) keep their tags inside the stream, so retagging
+# those may still change the fingerprint
+
+import hashlib
+import os
+import struct
+
+BLOCK_SIZE = 64 * 1024
+
+
+def _skipID3v2(f, offset):
+    f.seek(offset)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return offset
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7f)
+    # Footer present
+    if header[5] & 0x10:
+        size += 10
+    return offset + 10 + size
+
+
+def _skipFlacMetadata(f, offset):
+    f.seek(offset)
+    if f.read(4) != b"fLaC":
+        return offset
+    offset += 4
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return offset
+        offset += 4 + int.from_bytes(header[1:4], "big")
+        f.seek(offset)
+        if header[0] & 0x80:
+            return offset
+
+
+def _stripTrailingTags(f, start, end):
+    # ID3v1 sits in the last 128 bytes, an APEv2 tag can sit before it
+    if end - start >= 128:
+        f.seek(end - 128)
+        if f.read(3) == b"TAG":
+            end -= 128
+    if end - start >= 32:
+        f.seek(end - 32)
+        footer = f.read(32)
+        if footer[:8] == b"APETAGEX":
+            tagSize, _, flags = struct.unpack("<III", footer[12:24])
+            end -= tagSize
+            if flags & 0x80000000:
+                end -= 32
+    return max(start, end)
+
+
+def audioRange(f):
+    """ Return the (start, end) byte offsets of the audio stream of an open file """
+    end = f.seek(0, os.SEEK_END)
+    start = _skipFlacMetadata(f, _skipID3v2(f, 0))
+    return start, _stripTrailingTags(f, start, end)
+
+
+def genFingerprint(filePath, duration, blockSize=BLOCK_SIZE):
+    """ Hash the first and last blockSize bytes of the audio stream along with the duration """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filePath, "rb") as f:
+        start, end = audioRange(f)
+        f.seek(start)
+        digest.update(f.read(min(blockSize, end - start)))
+        if end - start > blockSize:
+            tailStart = max(start + blockSize, end - blockSize)
+            f.seek(tailStart)
+            digest.update(f.read(end - tailStart))
+    digest.update("{:.3f}".format(duration or 0).encode())
+    return digest.hexdigest()
@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
-import re
+
+# Rules rewriting tags before they're used for naming files
+# Rules on the same field are compiled into a single function, and its results
+# are cached since album and artist values repeat a lot across tracks
+
+import copy
+import functools
 import logging
+import re
+
 
 class ModifierRule:
     def __init__(self, field, match, replaceWith):
@@ -12,25 +20,59 @@ class ModifierRule:
         tmpMtd = metadata
         tmpValue = getattr(metadata, self.field)
         setattr(tmpMtd, self.field, self.match.sub(self.replaceWith, tmpValue))
-        if getattr(tmpMtd, self.field) != tmpValue:
-            logging.debug("replacing field {} from {} to {}".format(self.field, tmpValue, tmpMtd))
+        if getattr(tmpMtd, self.field) != tmpValue and logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("replacing field {} from {} to {}".format(self.field, tmpValue, getattr(tmpMtd, self.field)))
         return tmpMtd
 
 
 class Modifier:
-    modifiers = []
+    # Distinct values remembered per field
+    CACHE_SIZE = 65536
 
     def __init__(self, modifierRules=None):
         if modifierRules is None:
             modifierRules = []
+        self.modifiers = []
         for rules in modifierRules:
-            self.addRule(**rules)
-        pass
+            self.modifiers.append(ModifierRule(**rules))
+        self.compile()
 
     def addRule(self, field, match, replaceWith):
         self.modifiers.append(ModifierRule(field, match, replaceWith))
+        self.compile()
 
-    def apply(self, metadata):
+    def compile(self):
+        """ Build one cached function per field, running its rules in order """
+        byField = {}
         for modifier in self.modifiers:
-            metadata = modifier.apply(metadata)
-        return metadata
+            byField.setdefault(modifier.field, []).append((modifier.match.sub, modifier.replaceWith))
+        self.compiled = [(field, self.__compileField(subs)) for field, subs in byField.items()]
+
+    @classmethod
+    def __compileField(cls, subs):
+        subs = tuple(subs)
+
+        @functools.lru_cache(maxsize=cls.CACHE_SIZE)
+        def modify(value):
+            if value is None:
+                return None
+            for sub, replaceWith in subs:
+                value = sub(replaceWith, value)
+            return value
+        return modify
+
+    def apply(self, metadata):
+        """ Return metadata with every rule applied
+            metadata itself is never changed, a copy is returned if any field changed """
+        result = metadata
+        for field, modify in self.compiled:
+            value = getattr(metadata, field)
+            newValue = modify(value)
+            if newValue == value:
+                continue
+            if result is metadata:
+                result = copy.copy(metadata)
+            setattr(result, field, newValue)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("replacing field {} from {} to {}".format(field, value, newValue))
+        return result
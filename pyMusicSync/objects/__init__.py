@@ -4,3 +4,9 @@ from .album import Album
 from .track import Track
 from .record import Record
 from .progress import Progress
+from .metadata import Metadata
+from .scan_index import ScanIndex
+from .quarantine import Quarantine
+from .track_table import TrackTable
+from .destination_index import DestinationIndex
+from .staged_file import StagedFile
@@ -1,12 +1,35 @@
 #!/usr/bin/env python3
 
+from pyMusicSync import utils
+from .track import Track
+
+
 class Album:
     """ Class representing an album """
+    __slots__ = ["title", "directory", "tracks", "coverFile"]
 
-    def __init__(self, title):
+    def __init__(self, title, directory=None):
         self.title = str(title)
+        # Folder on the destination, see Destination.albumDirectory()
+        self.directory = directory or utils.pathSanitize(self.title)
         self.tracks = []
         self.coverFile = None
 
     def add(self, track):
         self.tracks.append(track)
+
+    def toDict(self):
+        return {
+            "title": self.title,
+            "directory": self.directory,
+            "coverFile": self.coverFile,
+            "tracks": [track.toDict() for track in self.tracks]
+        }
+
+    @classmethod
+    def fromDict(cls, data):
+        album = cls(data["title"], data.get("directory"))
+        album.coverFile = data["coverFile"]
+        for track in data["tracks"]:
+            album.add(Track.fromDict(track))
+        return album
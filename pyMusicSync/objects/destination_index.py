@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+
+
+class DestinationIndex:
+    """ Class representing the content of the destination directories
+        Every directory is listed at most once, then kept up to date as files are written and removed """
+
+    def __init__(self):
+        self.threadLock = threading.Lock()
+        self.listings = {}  # <directory>:{<file name>}
+        self.reserved = {}  # <directory>:<number of tracks being synced into it>
+
+    def __listing(self, directory):
+        # Caller must hold threadLock
+        listing = self.listings.get(directory)
+        if listing is None:
+            try:
+                listing = set(os.listdir(directory))
+            except FileNotFoundError:
+                listing = set()
+            self.listings[directory] = listing
+        return listing
+
+    def add(self, path):
+        directory, name = os.path.split(os.path.normpath(path))
+        with self.threadLock:
+            self.__listing(directory).add(name)
+
+    def remove(self, path):
+        directory, name = os.path.split(os.path.normpath(path))
+        with self.threadLock:
+            self.__listing(directory).discard(name)
+
+    def reserve(self, directory):
+        """ Never report directory as empty until release() is called as many times,
+            something is about to be written there """
+        directory = os.path.normpath(directory)
+        with self.threadLock:
+            self.reserved[directory] = self.reserved.get(directory, 0) + 1
+
+    def release(self, directory):
+        directory = os.path.normpath(directory)
+        with self.threadLock:
+            count = self.reserved.pop(directory) - 1
+            if count > 0:
+                self.reserved[directory] = count
+
+    def isEmpty(self, directory, ignore=()):
+        """ True if directory holds nothing but files named in ignore """
+        directory = os.path.normpath(directory)
+        with self.threadLock:
+            if directory in self.reserved:
+                return False
+            return self.__listing(directory) <= set(ignore)
+
+    def forget(self, directory):
+        with self.threadLock:
+            self.listings.pop(os.path.normpath(directory), None)
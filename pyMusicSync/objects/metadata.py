@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import sys
+
+
+class Metadata:
+    """ Class representing the parsed tags of an audio file, cached in the scan index
+        Keeps every field TinyTag parses, filters and modifiers may use any of them """
+    FIELDS = [
+        "album",
+        "albumartist",
+        "artist",
+        "title",
+        "track",
+        "disc",
+        "duration",
+        "bitrate",
+        "samplerate",
+        "year",
+        "genre",
+        "comment",
+        "composer",
+        "track_total",
+        "disc_total",
+        "channels",
+        "filesize",
+        "audio_offset",
+        # Not a tag, filled in by fingerprint.genFingerprint() in content identity mode
+        "fingerprint"
+    ]
+    __slots__ = FIELDS
+    # Values shared by many tracks, interned so every copy points to the same string
+    INTERNED_FIELDS = ["album", "albumartist", "artist", "track", "disc", "genre", "year",
+                       "composer", "track_total", "disc_total"]
+
+    def __init__(self, **fields):
+        for key in self.FIELDS:
+            self.__setattr__(key, fields.get(key))
+        for key in self.INTERNED_FIELDS:
+            value = getattr(self, key)
+            if type(value) is str:
+                self.__setattr__(key, sys.intern(value))
+
+    @classmethod
+    def fromTag(cls, tag):
+        return cls(**{key: getattr(tag, key, None) for key in cls.FIELDS})
+
+    def toDict(self):
+        result = {}
+        for key in self.FIELDS:
+            result[key] = getattr(self, key)
+        return result
+
+    def __repr__(self):
+        return "Metadata({})".format(self.toDict())
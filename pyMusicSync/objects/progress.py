@@ -1,21 +1,150 @@
 #!/usr/bin/env python3
 
+import collections
+import datetime
+import json
+import logging
+import os
+import sys
 import threading
+import time
 
 
-class Progress:
-    threadLock = threading.Lock()
-    finished = 0
-    total = 0
-    percent = 0.0
+class Counter:
+    """ Counts of a single thread, only ever written by that thread """
+    __slots__ = ("finished", "finishedSeconds", "total", "totalSeconds")
 
     def __init__(self):
-        pass
+        self.finished = 0
+        self.finishedSeconds = 0.0
+        self.total = 0
+        self.totalSeconds = 0.0
+
+
+class Progress:
+    """ Class counting synced tracks and the audio duration behind them
+        Every thread updates its own Counter without locking, readers add them up
+        Progress is reported at most every interval seconds, by whichever thread notices first """
+    OUTPUTS = ["log", "terminal", "json"]
+    # Seconds of history behind the rolling rates
+    WINDOW = 30
+
+    def __init__(self, interval=2.0, output="log", filePath="progress.json"):
+        if output is not None and output not in self.OUTPUTS:
+            raise NotImplementedError("Unimplemented progress output: {}".format(output))
+        if output == "terminal" and not sys.stderr.isatty():
+            output = "log"
+        self.interval = interval
+        self.output = output
+        self.filePath = filePath
+        self.local = threading.local()
+        self.registerLock = threading.Lock()
+        self.reportLock = threading.Lock()
+        self.counters = []
+        self.startTime = time.monotonic()
+        self.nextReport = self.startTime + interval
+        self.history = collections.deque([(self.startTime, 0, 0.0)])  # (<time>, <finished>, <finishedSeconds>)
+
+    def __counter(self):
+        counter = getattr(self.local, "counter", None)
+        if counter is None:
+            counter = Counter()
+            with self.registerLock:
+                # Replaced instead of appended to, so readers can iterate without the lock
+                self.counters = self.counters + [counter]
+            self.local.counter = counter
+        return counter
+
+    def increase(self, duration=None):
+        counter = self.__counter()
+        counter.finished += 1
+        counter.finishedSeconds += duration or 0
+        if time.monotonic() >= self.nextReport:
+            self.report()
+
+    def incTotal(self, duration=None):
+        counter = self.__counter()
+        counter.total += 1
+        counter.totalSeconds += duration or 0
+
+    def __sum(self, key):
+        return sum(getattr(counter, key) for counter in self.counters)
+
+    @property
+    def finished(self):
+        return self.__sum("finished")
+
+    @property
+    def total(self):
+        return self.__sum("total")
+
+    @property
+    def percent(self):
+        total = self.total
+        return self.finished / total * 100 if total else 0.0
+
+    def snapshot(self):
+        """ Current progress as a dict, rates are averaged over the last WINDOW seconds """
+        now = time.monotonic()
+        finished = self.__sum("finished")
+        finishedSeconds = self.__sum("finishedSeconds")
+        total = self.__sum("total")
+        remainingSeconds = max(0.0, self.__sum("totalSeconds") - finishedSeconds)
+        with self.registerLock:
+            self.history.append((now, finished, finishedSeconds))
+            while len(self.history) > 2 and self.history[1][0] < now - self.WINDOW:
+                self.history.popleft()
+            since, sinceFinished, sinceSeconds = self.history[0]
+        elapsed = now - since
+        tracksRate = (finished - sinceFinished) / elapsed if elapsed > 0 else 0.0
+        audioRate = (finishedSeconds - sinceSeconds) / elapsed if elapsed > 0 else 0.0
+        return {
+            "finished": finished,
+            "total": total,
+            "percent": finished / total * 100 if total else 0.0,
+            "elapsed": now - self.startTime,
+            "tracksPerSecond": tracksRate,
+            "audioSecondsPerSecond": audioRate,
+            "remainingAudioSeconds": remainingSeconds,
+            "eta": remainingSeconds / audioRate if audioRate > 0 else None
+        }
+
+    def report(self, force=False):
+        """ Output the current progress, unless another thread is already on it or it's too early """
+        if not self.reportLock.acquire(blocking=force):
+            return
+        try:
+            now = time.monotonic()
+            if not force and now < self.nextReport:
+                return
+            self.nextReport = now + self.interval
+            if self.output is None:
+                return
+            snapshot = self.snapshot()
+            if self.output == "json":
+                self.__writeJson(snapshot)
+            elif self.output == "terminal":
+                sys.stderr.write("\r\033[K" + self.format(snapshot) + ("\n" if force else ""))
+                sys.stderr.flush()
+            else:
+                logging.info(self.format(snapshot))
+        finally:
+            self.reportLock.release()
+
+    def __writeJson(self, snapshot):
+        tmpFile = self.filePath + ".tmp"
+        with open(tmpFile, "w") as f:
+            json.dump(snapshot, f, indent=4)
+        os.replace(tmpFile, self.filePath)
 
-    def increase(self):
-        with self.threadLock:
-            self.finished += 1
-            self.percent = (self.finished / self.total) * 100
+    @staticmethod
+    def format(snapshot):
+        eta = snapshot["eta"]
+        return "{}/{} tracks ({:.1f}%), {:.1f} tracks/s, {:.1f}x realtime, ETA {}".format(
+            snapshot["finished"], snapshot["total"], snapshot["percent"],
+            snapshot["tracksPerSecond"], snapshot["audioSecondsPerSecond"],
+            "unknown" if eta is None else datetime.timedelta(seconds=int(eta)))
 
-    def incTotal(self):
-        self.total += 1
+    def finish(self):
+        """ Report one last time, whatever the interval """
+        self.report(force=True)
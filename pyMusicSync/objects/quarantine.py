@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import threading
+
+
+class Quarantine:
+    """ Class representing a list of source files that failed to sync
+        A quarantined file is skipped until its mtime changes """
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.threadLock = threading.Lock()
+        self.entries = {}  # <sourcePath>:{"mtime": <mtime_ns>, "error": <message>}
+        self.added = []  # Files quarantined during this run
+        self.skipped = []  # Files skipped during this run because they're quarantined
+        if os.path.isfile(self.filePath):
+            self.read()
+
+    def read(self):
+        with open(self.filePath) as f:
+            self.entries = json.load(f)
+
+    def write(self):
+        with self.threadLock:
+            tmpPath = self.filePath + ".tmp"
+            with open(tmpPath, "w") as f:
+                json.dump(self.entries, f, indent=4)
+            os.replace(tmpPath, self.filePath)
+
+    def add(self, path, error):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self.threadLock:
+            self.entries[path] = {"mtime": mtime, "error": error}
+            self.added.append(path)
+        logging.warning("Quarantined {}: {}".format(path, error))
+
+    def __contains__(self, path):
+        """ True if path is quarantined and hasn't been modified since """
+        with self.threadLock:
+            entry = self.entries.get(path)
+        if entry is None:
+            return False
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != entry["mtime"]:
+            logging.info("{} changed, giving it another try".format(path))
+            with self.threadLock:
+                del self.entries[path]
+            return False
+        with self.threadLock:
+            self.skipped.append(path)
+        return True
+
+    def summary(self):
+        if self.added:
+            logging.warning("{} file(s) failed to sync and were quarantined:".format(len(self.added)))
+            for path in self.added:
+                logging.warning("  {}: {}".format(path, self.entries[path]["error"]))
+        if self.skipped:
+            logging.info("{} quarantined file(s) skipped, touch them or remove them from {} to retry"
+                         .format(len(self.skipped), self.filePath))
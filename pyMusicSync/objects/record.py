@@ -2,75 +2,269 @@
 
 import json
 import os
+import shutil
 import threading
 import time
 import logging
 
-from pyMusicSync import utils
+from pyMusicSync import utils, timing
 
 
 class Record:
-    """ Class representing a record file to keep track of converted and synced file """
-    threadLock = threading.Lock()
-    filePath = ""
-    record = {}  # <trackID>:<filePath>
+    """ Class representing a record file to keep track of converted and synced file
+        Every change is appended to a journal next to the record file, the record
+        file itself is only rewritten when the journal gets compacted """
+    # Compact once the journal holds more entries than the record itself
+    # (but never for fewer than COMPACT_MIN entries)
+    COMPACT_RATIO = 1.0
+    COMPACT_MIN = 1000
 
-    def __init__(self, filePath, interval):
+    def __init__(self, filePath, interval, batchSize=100):
         self.filePath = filePath
+        self.journalPath = filePath + ".journal"
+        self.oldJournalPath = filePath + ".journal.old"
+        self.threadLock = threading.Lock()
+        self.compactLock = threading.Lock()
+        # Wakes the autosave thread up when a batch is full or on shutdown
+        self.condition = threading.Condition(self.threadLock)
+        self.record = {}  # <trackID (bytes)>:<filePath>, IDs are stored as hex
+        self.idVersion = utils.ID_VERSION
+        self.journalEntries = 0
         if not (os.path.isfile(self.filePath)):
-            self.write()
+            self.__writeSnapshot(self.record)
         self.read()
+        self.journal = self.__openJournal()
         self.killed = False
-        self.hasUnsavedChanges = False
+        # Entries appended since the last flush, and when the oldest of them was appended
+        self.unflushed = 0
+        self.unflushedSince = None
         self.autosaveInterval = interval
-        self.autosaveThread = threading.Thread(target=self.__autosave)
+        self.autosaveBatchSize = batchSize
+        self.flushCount = 0
+        self.flushedEntries = 0
+        self.flushTime = 0.0
+        self.maxFlushTime = 0.0
+        self.autosaveThread = threading.Thread(target=self.__autosave, name="RecordAutosave")
 
     def read(self):
         with open(self.filePath) as f:
-            self.record = json.load(f)
+            data = json.load(f)
+        if "tracks" in data:
+            self.idVersion = data["idVersion"]
+            data = data["tracks"]
+        else:
+            # Written before IDs were versioned
+            self.idVersion = 1
+        self.record = {utils.idFromHex(trackID): path for trackID, path in data.items()}
+        # A journal left behind by an interrupted compaction comes first
+        self.journalEntries = 0
+        for path in (self.oldJournalPath, self.journalPath):
+            if os.path.isfile(path):
+                self.journalEntries += self.__replay(path)
+
+    def __replay(self, path):
+        count = 0
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Only the last line can be torn, by a crash in the middle of a write
+                    logging.warning("Ignoring corrupted journal entry in {}: {!r}".format(path, line))
+                    continue
+                if entry[0] == "+":
+                    self.record[utils.idFromHex(entry[1])] = entry[2]
+                elif entry[0] == "-":
+                    self.record.pop(utils.idFromHex(entry[1]), None)
+                count += 1
+        logging.debug("Replayed {} journal entries from {}".format(count, path))
+        return count
+
+    def __openJournal(self):
+        journal = open(self.journalPath, "a")
+        # Terminate a line torn by a crash, so the next entry doesn't get glued to it
+        if journal.tell() > 0:
+            with open(self.journalPath, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    journal.write("\n")
+        return journal
+
+    def __append(self, entry):
+        # Caller must hold threadLock
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journalEntries += 1
+        if self.unflushed == 0:
+            self.unflushedSince = time.monotonic()
+        self.unflushed += 1
+        # The first entry starts the autosaveInterval countdown, a full batch is flushed right away
+        if self.unflushed == 1 or self.unflushed >= self.autosaveBatchSize:
+            self.condition.notify()
 
     def add(self, track):
-        # Not thread-safe
         with self.threadLock:
             self.record[track.trackID] = track.syncedFilePath
-            self.hasUnsavedChanges = True
+            self.__append(["+", utils.idToHex(track.trackID), track.syncedFilePath])
 
     def remove(self, item):
         with self.threadLock:
             del self.record[item]
-            self.hasUnsavedChanges = True
+            self.__append(["-", utils.idToHex(item)])
 
-    def __contains__(self, item):
+    def removeMany(self, items):
         with self.threadLock:
-            trackID = utils.genID(item)
-            return trackID in self.record
+            for item in items:
+                del self.record[item]
+                self.__append(["-", utils.idToHex(item)])
+
+    def rekey(self, oldID, newID):
+        """ Keep the synced file of oldID, under newID """
+        with self.threadLock:
+            path = self.record.pop(oldID)
+            self.record[newID] = path
+            self.__append(["-", utils.idToHex(oldID)])
+            self.__append(["+", utils.idToHex(newID), path])
+
+    # Single lookups don't take threadLock, a dict lookup is atomic
+
+    def __contains__(self, item):
+        # Accept either a track ID or a metadata object
+        trackID = item if isinstance(item, bytes) else utils.genID(item)
+        return trackID in self.record
 
     def get(self, item):
         return self.record[item]
 
+    # Batch lookups iterate over the record, so they do
+
+    def intersection(self, trackIDs):
+        """ Set of trackIDs that are in the record """
+        with self.threadLock:
+            return self.record.keys() & trackIDs
+
+    def difference(self, trackIDs):
+        """ Set of IDs in the record that are not in trackIDs """
+        with self.threadLock:
+            return self.record.keys() - trackIDs
+
+    def paths(self, excludedIDs=()):
+        """ Set of the paths in the record, but the ones recorded under excludedIDs """
+        with self.threadLock:
+            return {path for trackID, path in self.record.items() if trackID not in excludedIDs}
+
+    def flush(self):
+        """ Make sure every change so far is on disk, compact the journal if it grew too big """
+        startTime = time.monotonic()
+        with timing.timer.measure("recordFlush"):
+            with self.compactLock:
+                with self.threadLock:
+                    batchSize = self.unflushed
+                    self.unflushed = 0
+                    self.unflushedSince = None
+                    self.journal.flush()
+                    needCompaction = self.journalEntries > max(self.COMPACT_MIN, self.COMPACT_RATIO * len(self.record))
+                # compactLock keeps the journal from being rotated under us,
+                # add() and remove() can carry on while we wait for the disk
+                os.fsync(self.journal.fileno())
+            if needCompaction:
+                self.write()
+        if batchSize:
+            self.__reportFlush(batchSize, time.monotonic() - startTime)
+
+    def __reportFlush(self, batchSize, latency):
+        with self.threadLock:
+            self.flushCount += 1
+            self.flushedEntries += batchSize
+            self.flushTime += latency
+            self.maxFlushTime = max(self.maxFlushTime, latency)
+        logging.debug("Flushed {} record entries in {:.1f} ms".format(batchSize, latency * 1000))
+
     def write(self):
+        """ Compact the journal into the record file """
+        with self.compactLock:
+            # Only hold threadLock long enough to copy the record and rotate the journal,
+            # writing the snapshot itself doesn't block add() and remove()
+            with self.threadLock:
+                snapshot = dict(self.record)
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.journal.close()
+                if os.path.isfile(self.oldJournalPath):
+                    # Left by an interrupted compaction, its entries aren't in the record file yet
+                    self.__appendJournal(self.journalPath, self.oldJournalPath)
+                    os.remove(self.journalPath)
+                else:
+                    os.replace(self.journalPath, self.oldJournalPath)
+                self.journal = self.__openJournal()
+                self.journalEntries = 0
+            self.__writeSnapshot(snapshot)
+            os.remove(self.oldJournalPath)
+            logging.debug("Compacted record with {} entries".format(len(snapshot)))
+
+    @staticmethod
+    def __appendJournal(src, dst):
+        """ Append the entries of journal src to journal dst, replaying both twice is harmless """
+        with open(dst, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            with open(src, "rb") as journal:
+                shutil.copyfileobj(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __writeSnapshot(self, snapshot):
+        tmpPath = self.filePath + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"idVersion": self.idVersion,
+                       "tracks": {utils.idToHex(trackID): path for trackID, path in snapshot.items()}}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.filePath)
+
+    def setIDVersion(self, version):
+        """ Mark every ID as generated by version, and compact so it's saved right away """
+        self.idVersion = version
+        self.write()
+
+    def close(self):
+        self.flush()
         with self.threadLock:
-            with open(self.filePath, "w") as f:
-                json.dump(self.record, f, indent=4)
+            self.journal.close()
 
     def idList(self):
-        return list(self.record.keys())
+        with self.threadLock:
+            return list(self.record.keys())
 
     def __autosave(self):
-        lastTime = time.monotonic()
         while True:
-            if self.killed:
+            with self.condition:
+                while not self.killed and self.unflushed < self.autosaveBatchSize:
+                    if self.unflushed == 0:
+                        self.condition.wait()
+                        continue
+                    remaining = self.unflushedSince + self.autosaveInterval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                killed = self.killed
+            self.flush()
+            if killed:
                 return
-            currTime = time.monotonic()
-            if self.hasUnsavedChanges and (currTime - lastTime >= self.autosaveInterval):
-                logging.debug("writing changes")
-                self.write()
-                self.hasUnsavedChanges = False
-                lastTime = currTime
-            time.sleep(0.1)
 
     def startAutosave(self):
         self.autosaveThread.start()
 
     def killAutosave(self):
-        self.killed = True
+        """ Stop the autosave thread, flushing whatever is left right away """
+        with self.condition:
+            self.killed = True
+            self.condition.notify()
+        if self.autosaveThread.is_alive():
+            self.autosaveThread.join()
+        if self.flushCount:
+            logging.info("Record: {} flushes, {:.1f} entries per flush, {:.1f} ms average, {:.1f} ms max latency"
+                         .format(self.flushCount, self.flushedEntries / self.flushCount,
+                                 self.flushTime / self.flushCount * 1000, self.maxFlushTime * 1000))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import sqlite3
+import threading
+
+from .metadata import Metadata
+
+
+class ScanIndex:
+    """ Class representing an on-disk cache of parsed tags, keyed by (path, size, mtime_ns)
+        Files that are not audio files are cached too, with empty metadata """
+    # Bump this whenever the table layout or Metadata.FIELDS changes,
+    # the whole index will be dropped and rebuilt on the next scan
+    VERSION = 3
+    # Commit pending rows every COMMIT_INTERVAL updates
+    COMMIT_INTERVAL = 1000
+    # VACUUM the database if compact() removed more than this fraction of rows
+    VACUUM_RATIO = 0.25
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.threadLock = threading.Lock()
+        self.entries = {}  # <path>:(<size>, <mtime_ns>, <Metadata or None>)
+        self.seen = set()
+        self.uncommitted = 0
+        self.db = sqlite3.connect(self.filePath, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.__createTable()
+        self.read()
+
+    def __createTable(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.VERSION:
+            logging.info("Scan index version mismatch ({} != {}), rebuilding".format(version, self.VERSION))
+            self.db.execute("DROP TABLE IF EXISTS scan")
+            self.db.execute("PRAGMA user_version = {:d}".format(self.VERSION))
+        self.db.execute("CREATE TABLE IF NOT EXISTS scan ("
+                        "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, valid INTEGER, {})"
+                        .format(", ".join(Metadata.FIELDS)))
+        self.db.commit()
+
+    def read(self):
+        columns = ["path", "size", "mtime", "valid"] + Metadata.FIELDS
+        cursor = self.db.execute("SELECT {} FROM scan".format(", ".join(columns)))
+        for row in cursor:
+            path, size, mtime, valid = row[:4]
+            metadata = Metadata(**dict(zip(Metadata.FIELDS, row[4:]))) if valid else None
+            self.entries[path] = (size, mtime, metadata)
+        logging.debug("Loaded {} entries from scan index".format(len(self.entries)))
+
+    def lookup(self, path, stat):
+        """ Return (True, metadata) if path is cached and unchanged, (False, None) otherwise """
+        with self.threadLock:
+            self.seen.add(path)
+            entry = self.entries.get(path)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            return False, None
+        return True, entry[2]
+
+    def put(self, path, stat, metadata):
+        if metadata is None:
+            values = [None] * len(Metadata.FIELDS)
+        else:
+            values = [getattr(metadata, key) for key in Metadata.FIELDS]
+        with self.threadLock:
+            self.seen.add(path)
+            self.entries[path] = (stat.st_size, stat.st_mtime_ns, metadata)
+            self.db.execute("INSERT OR REPLACE INTO scan VALUES ({})".format(", ".join(["?"] * (len(values) + 4))),
+                            [path, stat.st_size, stat.st_mtime_ns, metadata is not None] + values)
+            self.uncommitted += 1
+            if self.uncommitted >= self.COMMIT_INTERVAL:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def under(self, directory):
+        """ {<path>: <Metadata or None>} of every entry in directory or below """
+        prefix = os.path.join(directory, "")
+        with self.threadLock:
+            return {path: entry[2] for path, entry in self.entries.items() if path.startswith(prefix)}
+
+    def seenEntries(self):
+        """ {<path>: <Metadata or None>} of every entry seen since the index was opened,
+            entries of files that were deleted before aren't seen """
+        with self.threadLock:
+            return {path: self.entries[path][2] for path in self.seen if path in self.entries}
+
+    def remove(self, paths):
+        """ Drop the entries of deleted files right away, without waiting for compact() """
+        with self.threadLock:
+            for path in paths:
+                self.entries.pop(path, None)
+                self.seen.discard(path)
+            self.db.executemany("DELETE FROM scan WHERE path = ?", [(path,) for path in paths])
+            self.db.commit()
+            self.uncommitted = 0
+
+    def compact(self):
+        """ Drop every entry that wasn't seen since the index was opened
+            Only call this after a full traversal of every sync source """
+        with self.threadLock:
+            stale = [path for path in self.entries if path not in self.seen]
+            for path in stale:
+                del self.entries[path]
+            self.db.executemany("DELETE FROM scan WHERE path = ?", [(path,) for path in stale])
+            self.db.commit()
+            self.uncommitted = 0
+            if stale:
+                logging.info("Removed {} stale entries from scan index".format(len(stale)))
+            if len(stale) > self.VACUUM_RATIO * (len(self.entries) + len(stale)):
+                logging.debug("Vacuuming scan index")
+                self.db.execute("VACUUM")
+
+    def close(self):
+        with self.threadLock:
+            self.db.commit()
+            self.db.close()
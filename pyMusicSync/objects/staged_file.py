@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+
+
+class StagedFile:
+    """ Class representing a file copied to several destinations
+        It's removed once every copy released it """
+
+    def __init__(self, path, users):
+        self.path = path
+        self.users = users
+        self.threadLock = threading.Lock()
+
+    def release(self):
+        with self.threadLock:
+            self.users -= 1
+            last = (self.users == 0)
+        if last:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
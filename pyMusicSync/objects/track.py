@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 
 from pyMusicSync import utils
 
@@ -8,15 +9,36 @@ from pyMusicSync import utils
 class Track:
     """ Class representing a track (in an album)
         All file path are relative to syncDst """
+    SERIALIZED_FIELDS = ["album", "title", "duration", "filePath", "lossless", "trackID", "trackNumber"]
+    __slots__ = SERIALIZED_FIELDS + ["syncedFilePath"]
 
-    def __init__(self, metadata, filePath):
-        self.album = str(metadata.album)
+    def __init__(self, metadata, filePath, trackID=None):
+        self.album = sys.intern(str(metadata.album))
         self.title = str(metadata.title)
+        self.duration = metadata.duration
         self.filePath = filePath
         ext = os.path.splitext(filePath)
         self.lossless = ((ext[1] == ".flac") or (ext[1] == ".wma"))
-        self.trackID = utils.genID(metadata)
+        self.trackID = utils.genID(metadata) if trackID is None else trackID
+        self.syncedFilePath = None
         try:
             self.trackNumber = int(metadata.track)
         except (TypeError, ValueError):
             self.trackNumber = None
+
+    def toDict(self):
+        result = {}
+        for key in self.SERIALIZED_FIELDS:
+            result[key] = getattr(self, key)
+        result["trackID"] = utils.idToHex(self.trackID)
+        return result
+
+    @classmethod
+    def fromDict(cls, data):
+        track = cls.__new__(cls)
+        for key in cls.SERIALIZED_FIELDS:
+            setattr(track, key, data[key])
+        track.album = sys.intern(track.album)
+        track.trackID = utils.idFromHex(track.trackID)
+        track.syncedFilePath = None
+        return track
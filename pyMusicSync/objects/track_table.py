@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import array
+import itertools
+import operator
+import os
+import sys
+
+# Optional, only --query builds a TrackTable
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyMusicSync import filter
+from .metadata import Metadata
+
+
+class Column:
+    """ Dictionary-encoded column: every row holds the code of a distinct value """
+    NUMERIC_OPERATORS = {
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge
+    }
+
+    def __init__(self):
+        self.codes = array.array("I")
+        self.values = []  # <code>:<value>
+        self.lookup = {}  # <value>:<code>
+        self.numbers = None
+
+    def append(self, value):
+        if isinstance(value, str):
+            value = sys.intern(value)
+        code = self.lookup.get(value)
+        if code is None:
+            code = len(self.values)
+            self.lookup[value] = code
+            self.values.append(value)
+        self.codes.append(code)
+        self.numbers = None
+
+    def __numbers(self):
+        """ The column as floats, NaN where the value isn't a number """
+        if self.numbers is None:
+            distinct = numpy.array([filter.toNumber(value) for value in self.values], dtype=numpy.float64)
+            self.numbers = distinct[numpy.frombuffer(self.codes, dtype=numpy.uint32)]
+        return self.numbers
+
+    def mask(self, rule):
+        """ Evaluate rule on the whole column, return a boolean array (applyNot is left to the caller) """
+        if rule.isNumeric():
+            numbers = self.__numbers()
+            # NaN never matches, like None in FilterRule
+            with numpy.errstate(invalid="ignore"):
+                if rule.operator == "range":
+                    low, high = rule.value
+                    return (numbers >= low) & (numbers <= high)
+                return self.NUMERIC_OPERATORS[rule.operator](numbers, rule.value)
+        # Everything else is only evaluated once per distinct value
+        compare = rule.comparator()
+        matching = numpy.fromiter((bool(compare(value)) for value in self.values),
+                                  dtype=numpy.bool_, count=len(self.values))
+        return matching[numpy.frombuffer(self.codes, dtype=numpy.uint32)]
+
+
+class TrackTable:
+    """ Columnar copy of the scan index, used to run filters over the whole library at once
+        Changing the filters only needs a new select(), not a new scan """
+    COLUMNS = [key for key in Metadata.FIELDS if key != "fingerprint"] + sorted(filter.Filter.PATH_FIELDS)
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("NumPy is needed to query the scan index, install it with pip install numpy")
+        self.paths = []
+        self.columns = {name: Column() for name in self.COLUMNS}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def append(self, path, size, metadata):
+        self.paths.append(path)
+        for key in Metadata.FIELDS:
+            if key in self.columns:
+                self.columns[key].append(getattr(metadata, key))
+        self.columns["path"].append(path)
+        self.columns["filename"].append(os.path.basename(path))
+        self.columns["extension"].append(os.path.splitext(path)[1].lower())
+        self.columns["size"].append(size)
+
+    @classmethod
+    def fromScanIndex(cls, scanIndex):
+        table = cls()
+        for path, (size, _, metadata) in scanIndex.entries.items():
+            if metadata is not None:
+                table.append(path, size, metadata)
+        return table
+
+    def mask(self, rule):
+        if isinstance(rule, filter.FilterGroup):
+            result = numpy.full(len(self.paths), rule.mode == "all", dtype=numpy.bool_)
+            for child in rule.rules:
+                if rule.mode == "all":
+                    result &= self.mask(child)
+                else:
+                    result |= self.mask(child)
+        else:
+            result = self.columns[rule.field].mask(rule)
+        if rule.applyNot:
+            result = ~result
+        return result
+
+    def select(self, trackFilter):
+        """ Return the path of every track passing trackFilter """
+        result = numpy.ones(len(self.paths), dtype=numpy.bool_)
+        for rule in trackFilter.pathRules + trackFilter.rules:
+            result &= self.mask(rule)
+        return list(itertools.compress(self.paths, result.tobytes()))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# A sync plan lists everything a run is going to do, so it can be
+# reviewed (or saved to a file) before anything is written to the destination
+
+import json
+import logging
+import os
+
+from pyMusicSync import objects, utils
+
+
+class SyncPlan:
+    VERSION = 3
+    # Version 2 plans only differ by not naming their destination
+    COMPATIBLE_VERSIONS = (2, 3)
+
+    def __init__(self, albums=None, moves=None, deletes=None, destination=None):
+        self.albums = albums or []  # [<Album>], with the tracks to encode or copy
+        self.moves = moves or []  # [(<Album>, <Track>, <old path>)]
+        self.deletes = deletes or []  # [(<trackID>, <path>)]
+        self.destination = destination  # Root of the destination, None for syncDestination
+
+    def toEncode(self):
+        return [track for album in self.albums for track in album.tracks if track.lossless]
+
+    def toCopy(self):
+        return [track for album in self.albums for track in album.tracks if not track.lossless]
+
+    def coverUpdates(self):
+        """ (<cover file>, <album directory>) of every album that gets initialized """
+        return [(album.coverFile, album.directory)
+                for album in self.albums if album.coverFile is not None]
+
+    def estimate(self, encoderSetting):
+        """ Return (<encode CPU seconds>, <bytes written>) """
+        encodeDuration = sum(track.duration or 0 for track in self.toEncode())
+        cpuSeconds = encodeDuration / encoderSetting.ENCODE_SPEED.get(encoderSetting.codec, 1)
+        bytesWritten = encodeDuration * encoderSetting.estimatedBitrate() * 1000 / 8
+        for track in self.toCopy():
+            try:
+                bytesWritten += os.path.getsize(track.filePath)
+            except OSError:
+                pass
+        return cpuSeconds, int(bytesWritten)
+
+    def summary(self, encoderSetting):
+        cpuSeconds, bytesWritten = self.estimate(encoderSetting)
+        if self.destination is not None:
+            logging.info("Plan for {}".format(self.destination))
+        logging.info("Plan: {} to encode, {} to copy, {} to move, {} to delete, {} cover(s)"
+                     .format(len(self.toEncode()), len(self.toCopy()), len(self.moves),
+                             len(self.deletes), len(self.coverUpdates())))
+        logging.info("Plan: about {:.0f} CPU seconds of encoding, {:.1f} MiB written"
+                     .format(cpuSeconds, bytesWritten / 2 ** 20))
+        for album, track, oldPath in self.moves:
+            logging.debug("  move {} ({})".format(oldPath, album.title))
+        for trackID, path in self.deletes:
+            logging.debug("  delete {} ({})".format(path, utils.idToHex(trackID)))
+
+    def toDict(self):
+        return {
+            "version": self.VERSION,
+            "destination": self.destination,
+            "albums": [album.toDict() for album in self.albums],
+            "moves": [{"album": album.title, "directory": album.directory, "track": track.toDict(), "from": oldPath}
+                      for album, track, oldPath in self.moves],
+            "deletes": [[utils.idToHex(trackID), path] for trackID, path in self.deletes]
+        }
+
+    @classmethod
+    def fromDict(cls, data):
+        if data.get("version") not in cls.COMPATIBLE_VERSIONS:
+            raise ValueError("Unsupported plan version: {}".format(data.get("version")))
+        albums = [objects.Album.fromDict(album) for album in data["albums"]]
+        albumMap = {album.directory: album for album in albums}
+        moves = [(albumMap[move.get("directory") or utils.pathSanitize(move["album"])],
+                  objects.Track.fromDict(move["track"]), move["from"])
+                 for move in data["moves"]]
+        deletes = [(utils.idFromHex(trackID), path) for trackID, path in data["deletes"]]
+        return cls(albums, moves, deletes, data.get("destination"))
+
+    def save(self, filePath):
+        with open(filePath, "w") as f:
+            json.dump(self.toDict(), f, indent=4)
+
+    @classmethod
+    def load(cls, filePath):
+        with open(filePath) as f:
+            return cls.fromDict(json.load(f))
+
+
+def savePlans(plans, filePath):
+    """ Save the plans of every destination into one file """
+    with open(filePath, "w") as f:
+        json.dump([plan.toDict() for plan in plans], f, indent=4)
+
+
+def loadPlans(filePath):
+    """ Load plans saved by savePlans(), or a single plan saved by SyncPlan.save() """
+    with open(filePath) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = [data]
+    return [SyncPlan.fromDict(plan) for plan in data]
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+
+from tinytag import TinyTag
+
+from pyMusicSync import objects, fingerprint, timing
+
+
+def walk(folderPath):
+    """ os.walk replacement built on os.scandir
+        Yields (root, [DirEntry]) for every directory, files only """
+    stack = [folderPath]
+    while stack:
+        root = stack.pop()
+        files = []
+        subdirs = []
+        try:
+            with timing.timer.measure("traversal"), os.scandir(root) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry)
+        except OSError as e:
+            logging.warning("Unable to list {}: {}".format(root, e))
+            continue
+        yield root, sorted(files, key=lambda entry: entry.name)
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+def readMetadata(fullPath, withFingerprint=False):
+    """ Parse the tags of fullPath, return None if it's not an audio file
+        Runs inside the worker processes, so it must stay picklable """
+    try:
+        metadata = objects.Metadata.fromTag(TinyTag.get(fullPath))
+    except LookupError:
+        return None
+    if withFingerprint:
+        metadata.fingerprint = fingerprint.genFingerprint(fullPath, metadata.duration)
+    return metadata
+
+
+def timedReadMetadata(fullPath, withFingerprint=False):
+    """ readMetadata(), along with the wall and CPU time it took in the worker process
+        and the error that kept it from reading fullPath, None if there wasn't any """
+    startWall = time.perf_counter()
+    startCPU = time.process_time()
+    try:
+        metadata = readMetadata(fullPath, withFingerprint)
+        error = None
+    except Exception as e:
+        # Damaged files (tinytag raises struct.error on a truncated Ogg...) mustn't end the scan
+        metadata = None
+        error = repr(e)
+    return metadata, error, time.perf_counter() - startWall, time.process_time() - startCPU
+
+
+class Scanner:
+    """ Parallel library scanner
+        Directories are walked in the calling thread, tags of new or changed files
+        are parsed in a process pool, and results are yielded one directory at a time """
+    # How many directories may be waiting for their tags per worker
+    DIRS_PER_WORKER = 4
+
+    def __init__(self, scanIndex, workers=None, withFingerprint=False, pathFilter=None):
+        self.scanIndex = scanIndex
+        self.pathFilter = pathFilter
+        self.workers = workers or os.cpu_count() or 1
+        self.withFingerprint = withFingerprint
+        self.executor = None
+
+    def __enter__(self):
+        # Syncing may already be running, forking a process with threads can deadlock the child
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                               mp_context=multiprocessing.get_context(method))
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+        self.executor = None
+
+    def __filter(self, files):
+        """ [(<DirEntry>, <stat>)] of files, but the ones rejected by the path filter,
+            which are never parsed. The filter is timed once per directory """
+        entries = [(entry, entry.stat()) for entry in files]
+        if self.pathFilter is None:
+            return entries
+        with timing.timer.measure("filtering"):
+            return [(entry, stat) for entry, stat in entries if self.pathFilter.checkPath(entry.path, stat)]
+
+    def __lookup(self, entry, stat):
+        """ Return (stat, metadata) if cached, (stat, Future) otherwise """
+        found, metadata = self.scanIndex.lookup(entry.path, stat)
+        # Entries indexed in metadata identity mode don't have a fingerprint yet
+        if found and (metadata is None or metadata.fingerprint is not None or not self.withFingerprint):
+            return stat, metadata
+        return stat, self.executor.submit(timedReadMetadata, entry.path, self.withFingerprint)
+
+    def __collect(self, root, pending):
+        result = []
+        for path, (stat, metadata) in pending:
+            if isinstance(metadata, concurrent.futures.Future):
+                metadata, error, wall, cpu = metadata.result()
+                timing.timer.add("tagParsing", wall, cpu)
+                if error is not None:
+                    # Indexed as not audio, so it's only read again once it changes
+                    logging.warning("Unable to read {}, skipping it: {}".format(path, error))
+                self.scanIndex.put(path, stat, metadata)
+            if metadata is not None:
+                result.append((path, metadata))
+        return root, result
+
+    def scan(self, folderPath):
+        """ Yield (root, [(fullPath, metadata)]) for every directory under folderPath,
+            in walk order, skipping files that are not audio files """
+        window = collections.deque()
+        maxWindow = self.workers * self.DIRS_PER_WORKER
+        for root, files in walk(folderPath):
+            pending = [(entry.path, self.__lookup(entry, stat)) for entry, stat in self.__filter(files)]
+            window.append((root, pending))
+            # Hand out every directory at the head of the window that is already parsed
+            while window and (len(window) > maxWindow or self.__isDone(window[0][1])):
+                yield self.__collect(*window.popleft())
+        while window:
+            yield self.__collect(*window.popleft())
+
+    @staticmethod
+    def __isDone(pending):
+        return all(not isinstance(metadata, concurrent.futures.Future) or metadata.done()
+                   for _, (_, metadata) in pending)
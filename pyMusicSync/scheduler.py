@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Job scheduler used for syncing tracks
+# Every lane has its own worker threads and its own priority queue,
+# so CPU-bound encodes and I/O-bound copies don't throttle each other
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+
+def autoWorkers():
+    """ Number of CPUs that aren't already busy with something else """
+    cpuCount = os.cpu_count() or 1
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        load = 0
+    return max(1, cpuCount - int(round(load)))
+
+
+class Lane:
+    """ A pool of worker threads picking jobs from a priority queue, highest priority first """
+
+    def __init__(self, name, workers, maxQueued=None):
+        self.name = name
+        self.workers = workers
+        self.maxQueued = maxQueued
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (-priority, <sequence>, <Future>, <fn>, <args>)
+        self.sequence = itertools.count()
+        self.stopping = False
+        self.active = 0
+        self.completed = 0
+        self.busyTime = 0.0
+        self.maxDepth = 0
+        self.startTime = time.monotonic()
+        self.threads = [threading.Thread(target=self.__worker, name="{}-{}".format(name, i))
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, priority, fn, *args):
+        future = concurrent.futures.Future()
+        with self.condition:
+            # Backpressure, block the producer until the workers catch up
+            while self.maxQueued is not None and len(self.queue) >= self.maxQueued and not self.stopping:
+                self.condition.wait()
+            if self.stopping:
+                raise RuntimeError("Lane {} is shut down".format(self.name))
+            heapq.heappush(self.queue, (-priority, next(self.sequence), future, fn, args))
+            self.maxDepth = max(self.maxDepth, len(self.queue))
+            self.condition.notify_all()
+        return future
+
+    def __worker(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                _, _, future, fn, args = heapq.heappop(self.queue)
+                self.active += 1
+                self.condition.notify_all()
+            if future.set_running_or_notify_cancel():
+                startTime = time.monotonic()
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    logging.exception("Job failed in lane {}".format(self.name))
+                    future.set_exception(e)
+                elapsed = time.monotonic() - startTime
+            else:
+                elapsed = 0.0
+            with self.condition:
+                self.active -= 1
+                self.completed += 1
+                self.busyTime += elapsed
+
+    def shutdown(self, cancelPending=False):
+        with self.condition:
+            self.stopping = True
+            if cancelPending:
+                for _, _, future, _, _ in self.queue:
+                    future.cancel()
+                self.queue = []
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def depth(self):
+        with self.condition:
+            return len(self.queue)
+
+    def utilisation(self):
+        wallTime = time.monotonic() - self.startTime
+        with self.condition:
+            return self.busyTime / (wallTime * self.workers) if wallTime > 0 else 0.0
+
+
+class Scheduler:
+    """ Runs jobs in named lanes, e.g. {"encode": 4, "copy": 2} """
+    # Seconds between two status lines
+    REPORT_INTERVAL = 30
+
+    def __init__(self, lanes, maxQueued=None):
+        self.lanes = {name: Lane(name, workers, maxQueued) for name, workers in lanes.items()}
+        for name, lane in self.lanes.items():
+            logging.info("Scheduler lane {} with {} worker(s)".format(name, lane.workers))
+        self.stopped = threading.Event()
+        self.reporter = threading.Thread(target=self.__reportLoop, name="SchedulerReport", daemon=True)
+        self.reporter.start()
+
+    def submit(self, lane, priority, fn, *args):
+        """ Queue fn(*args) in lane, jobs with a higher priority run first """
+        return self.lanes[lane].submit(priority, fn, *args)
+
+    def report(self, level=logging.INFO):
+        for name, lane in self.lanes.items():
+            logging.log(level, "Lane {}: {} done, {} running, {} queued (max {}), {:.0f}% utilisation"
+                        .format(name, lane.completed, lane.active, lane.depth(), lane.maxDepth,
+                                lane.utilisation() * 100))
+
+    def __reportLoop(self):
+        while not self.stopped.wait(self.REPORT_INTERVAL):
+            self.report(logging.DEBUG)
+
+    def shutdown(self, cancelPending=False):
+        """ Wait for every job to finish, or only the running ones if cancelPending """
+        for lane in self.lanes.values():
+            lane.shutdown(cancelPending)
+        self.stopped.set()
+        self.report()
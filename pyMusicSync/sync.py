@@ -1,115 +1,318 @@
 #!/usr/bin/env python3
 
-import concurrent.futures
+import itertools
 import logging
 import os
 import shutil
+import tempfile
 
-from tinytag import TinyTag
-
-from pyMusicSync import encoder, objects, utils, cover_art
+from pyMusicSync import encoder, objects, utils, scanner, scheduler, cache, fastcopy, timing, destination
 
 
 class musicSync:
-    albums = {}
-    trackIDList = set()
-    progress = objects.Progress()
+    """ Scans the library once and syncs it to every destination
+        Encodes are shared by destinations with the same encoder output """
+    COVER_NAMES = destination.Destination.COVER_NAMES
 
     def __init__(self, config):
-        self.record = objects.Record("record.json", config.autosaveInterval)
+        self.scanIndex = objects.ScanIndex(config.scanIndex)
+        self.coverCache = cache.FileCache(os.path.join(config.cacheDirectory, "covers"),
+                                          config.coverCacheSize * 2 ** 20, suffix=".jpg")
+        self.copier = fastcopy.FastCopier(config.copyCompareHash)
+        # Encodes of earlier runs, so rebuilding a device doesn't encode everything again
+        self.transcodeCache = None
+        if config.transcodeCacheSize and not config.dryRun:
+            self.transcodeCache = cache.FileCache(os.path.join(config.cacheDirectory, "transcodes"),
+                                                  config.transcodeCacheSize * 2 ** 20)
+        # Encodes shared by several destinations and cache hits wait in here, on a local disk,
+        # until every destination got its copy. Cache hits are hard linked, so an eviction meanwhile
+        # only unlinks the cached name
+        self.stagingDirectory = None
+        if not config.dryRun:
+            self.stagingDirectory = tempfile.mkdtemp(prefix="staging_",
+                                                     dir=os.path.expanduser(config.cacheDirectory))
+        self.stagingNames = itertools.count()
         self.config = config
-        self.record.startAutosave()
+        self.scheduler = None
+        self.scanned = False
+        self.progress = objects.Progress(config.progressInterval, config.progressOutput, config.progressFile)
+        timing.timer.start()
+        configs = config.destinationConfigs()
+        # The scanner can only skip files by path for a single destination,
+        # otherwise every destination checks its own path filters
+        self.destinations = [destination.Destination(destinationConfig, self, checkPaths=len(configs) > 1)
+                             for destinationConfig in configs]
 
     @staticmethod
     def __detectCoverFile(root):
-        possibleNames = ["cover_override.jpg", "cover.png", "cover.jpg", "folder.jpg",
-                         "Cover.jpg", "folder.jpeg", "cover.jpeg", "folder.png"]
-        for name in possibleNames:
+        for name in musicSync.COVER_NAMES:
             cover = os.path.join(root, name)
             if os.path.isfile(cover):
                 return cover
         return None
 
     def folderTraversal(self, folderPath):
-        for root, subdir, files in os.walk(folderPath):
-            hasMusic = False
-            albumName = ""
-            for f in files:
-                fullPath = os.path.join(root, f)
-                try:
-                    metadata = TinyTag.get(fullPath)
-                except LookupError:
-                    # File is not a valid audio file, skip
-                    continue
-                metadata.album = str(metadata.album)
-                self.trackIDList.add(utils.genID(metadata))
-                if self.config.filter.check(metadata) and not (metadata in self.record):
-                    albumName = metadata.album
-                    if albumName not in self.albums:
-                        self.albums[albumName] = objects.Album(albumName)
-                    newTrack = objects.Track(metadata, fullPath)
-                    self.albums[albumName].add(newTrack)
-                    hasMusic = True
-                    self.progress.incTotal()
-            if hasMusic:
-                # Handle cover image
-                self.albums[albumName].coverFile = self.__detectCoverFile(root)
-                logging.info("Album: %s with %d song(s)" %
-                             (albumName, len(self.albums[albumName].tracks)))
-
-    def __trackHandle(self, track):
-        if not self.config.dryRun:
-            if track.lossless:
-                track.syncedFilePath = encoder.encode(track.filePath, self.__getFilePath(track),
-                                                      self.config.encoderSetting)
-            else:
-                track.syncedFilePath = self.__getFilePath(track, ext=os.path.splitext(track.filePath)[1])
-                shutil.copy(track.filePath, track.syncedFilePath)
-        self.record.add(track)
-        self.progress.increase()
-        logging.info("Processed track {} ({:.2f}%)".format(track.title, self.progress.percent))
-
-    def __createAlbumDirectory(self, album):
-        dirName = utils.pathSanitize(album.title)
-        logging.info("Sanitized album folder name: {} => {}".format(album.title, dirName))
-        if not os.path.isdir(dirName):
-            os.mkdir(dirName)
-        if album.coverFile is not None:
-            cover_art.copy_cover_art(album.coverFile, dirName, self.config.upscaleSetting)
+        """ Scan folderPath, albums are submitted for syncing as soon as they're scanned
+            if startSync() was called before """
+        self.scanned = True
+        withFingerprint = (self.config.trackIdentity == "content")
+        pathFilter = self.config.filter if len(self.destinations) == 1 else None
+        with scanner.Scanner(self.scanIndex, self.config.scanThreadNum, withFingerprint,
+                             pathFilter) as libraryScanner:
+            for root, files in libraryScanner.scan(folderPath):
+                self.__directoryHandle(root, files)
+
+    def syncDirectories(self, directories):
+        """ Scan and sync directories (and what's below them) only, for watch mode
+            Tracks that are gone from them are pruned right away, syncing must be started """
+        withFingerprint = (self.config.trackIdentity == "content")
+        pathFilter = self.config.filter if len(self.destinations) == 1 else None
+        candidates = set()  # ID of every track that was in directories before
+        foundIDs = set()
+        gonePaths = []
+        with scanner.Scanner(self.scanIndex, self.config.scanThreadNum, withFingerprint,
+                             pathFilter) as libraryScanner:
+            for directory in self.__outermost(directories):
+                before = self.scanIndex.under(directory)
+                if os.path.isdir(directory):
+                    for root, files in libraryScanner.scan(directory):
+                        foundIDs.update(self.__directoryHandle(root, files))
+                gonePaths.extend(path for path in before if not os.path.isfile(path))
+                candidates.update(self.__indexedIDs(before.items()))
+        self.scanIndex.remove(gonePaths)
+        # The same track may still be somewhere else in the library
+        removed = candidates - foundIDs - self.__indexedIDs(self.scanIndex.seenEntries().items())
+        with timing.timer.measure("prune"):
+            for target in self.destinations:
+                target.wanted -= removed
+                # Found tracks aren't wanted anymore if their new tags are rejected by the filters
+                target.prune(target.staleTracks(removed | foundIDs))
+
+    @staticmethod
+    def __outermost(directories):
+        """ directories without the ones below another of them, which get scanned anyway """
+        result = []
+        for directory in sorted(directories):
+            if not result or not directory.startswith(os.path.join(result[-1], "")):
+                result.append(directory)
+        return result
+
+    def __indexedIDs(self, entries):
+        """ Track IDs of scan index entries, (<path>, <Metadata or None>) """
+        trackIDs = set()
+        for path, metadata in entries:
+            if metadata is None or (self.config.trackIdentity == "content" and metadata.fingerprint is None):
+                continue
+            trackIDs.add(utils.genID(metadata, self.config.trackIdentity, os.path.dirname(path)))
+        return trackIDs
+
+    def __directoryHandle(self, root, files):
+        """ Hand the tracks found in root to every destination, return their IDs """
+        scanned = []  # [(<full path>, <Metadata>, <trackID>)]
+        for fullPath, metadata in files:
+            metadata.album = str(metadata.album)
+            trackID = utils.genID(metadata, self.config.trackIdentity, os.path.dirname(fullPath))
+            scanned.append((fullPath, metadata, trackID))
+        classified = []  # [(<Destination>, <new tracks>, <moved tracks>)]
+        for target in self.destinations:
+            newTracks = {}  # <albumName>:[<Track>]
+            movedTracks = {}  # <albumName>:[<Track>]
+            target.classify(scanned, newTracks, movedTracks)
+            if newTracks or movedTracks:
+                classified.append((target, newTracks, movedTracks))
+        if not classified:
+            return [trackID for _, _, trackID in scanned]
+        coverFile = self.__detectCoverFile(root)
+        batch = []
+        for target, newTracks, movedTracks in classified:
+            batch.extend(target.addTracks(root, coverFile, newTracks, movedTracks))
+        if self.scheduler is not None:
+            self.__submit(batch)
+        return [trackID for _, _, trackID in scanned]
+
+    def __submit(self, batch):
+        """ Submit the tracks of [(<Destination>, <Album>, [<Track>])]
+            A source going to several destinations with the same encoder output is only encoded once """
+        encodes = {}  # (<source>, <output key>):[(<Destination>, <Track>)]
+        for target, album, tracks in batch:
+            target.initAlbum(album)
+            for track in tracks:
+                if track.lossless:
+                    key = (track.filePath, target.config.encoderSetting.outputKey())
+                    encodes.setdefault(key, []).append((target, track))
+                else:
+                    self.scheduler.submit(target.lane, track.duration or 0, target.copyTrack, track)
+        for jobs in encodes.values():
+            # Longest tracks first, so the run doesn't end waiting on a few long encodes
+            self.scheduler.submit("encode", jobs[0][1].duration or 0, self.__encodeShared, jobs)
+
+    def __encodeShared(self, jobs):
+        """ Encode the source of jobs once. With a single destination, FFmpeg writes straight into it,
+            otherwise into the staging directory, and every destination copies it on its own lane
+            so a slow device never holds up the encode lane """
+        if self.config.dryRun:
+            for target, track in jobs:
+                target.copyTrack(track)
+            return
+        target, track = jobs[0]
+        try:
+            staged = self.__stage(jobs)
+        except encoder.EncodeError as e:
+            for target, track in jobs:
+                target.fail(track, e.stderr)
+            return
+        except Exception as e:
+            # Killed FFmpeg, full or unwritable staging directory, unreadable source...
+            # None of it is the file's fault, it's tried again on the next run
+            for target, track in jobs:
+                target.skip(track, e)
+            return
+        if staged is None:
+            return
+        staged = objects.StagedFile(staged, len(jobs))
+        for target, track in jobs:
+            self.scheduler.submit(target.lane, track.duration or 0, self.__copyStaged, target, track, staged)
+
+    def __stage(self, jobs):
+        """ Put an encode of the source of jobs in the staging directory, from the transcode cache if it's there,
+            and return its path. Return None if it was encoded straight into the only destination instead """
+        target, track = jobs[0]
+        setting = target.config.encoderSetting
+        staged = os.path.join(self.stagingDirectory, str(next(self.stagingNames)))
+        cacheKey = None
+        if self.transcodeCache is not None:
+            cacheKey = encoder.cacheKey(track.filePath, setting)
+            if self.transcodeCache.link(cacheKey, staged + setting.ext):
+                return staged + setting.ext
+        if len(jobs) == 1:
+            output = target.encodeTrack(track)
+            staged = None
+        else:
+            output = encoder.encode(track.filePath, staged, setting, self.config.encodeRetries,
+                                    duration=track.duration)
+            staged = output
+        if cacheKey is not None:
+            self.__cacheEncode(cacheKey, output)
+        return staged
+
+    @staticmethod
+    def __copyStaged(target, track, staged):
+        try:
+            target.copyTrack(track, staged.path)
+        except OSError as e:
+            target.skip(track, e)
+        finally:
+            staged.release()
+
+    def __cacheEncode(self, cacheKey, output):
+        try:
+            with timing.timer.measure("transcodeCache", bytesIn=os.path.getsize(output)):
+                self.transcodeCache.put(cacheKey, output)
+        except Exception as e:
+            # The track is synced all the same, it'll only be encoded again next time
+            logging.warning("Unable to cache {}: {}".format(output, e))
 
     def startSync(self):
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.threadNum)
-        for albumName, album in self.albums.items():
-            logging.info("Initializing album {}".format(albumName))
-            self.__createAlbumDirectory(self.albums[albumName])
-            for track in album.tracks:
-                executor.submit(self.__trackHandle, track)
-        executor.shutdown()
-
-    def prune(self):
-        possibleCoverNames = {"cover_override.jpg", "cover.png", "cover.jpg", "folder.jpg",
-                              "Cover.jpg", "folder.jpeg", "cover.jpeg", "folder.png"}
-        for trackID in self.record.idList():
-            if trackID not in self.trackIDList:
-                logging.info("Removing old track {}".format(trackID))
-                os.remove(self.record.get(trackID))
-                fileDir = os.path.split(self.record.get(trackID))[0]
-                if set(os.listdir(fileDir)) - possibleCoverNames == set():
-                    logging.info("Removing empty folder {}".format(fileDir))
-                    shutil.rmtree(fileDir)
-                self.record.remove(trackID)
+        """ Start the encoder pool and submit every album scanned so far """
+        threadNum = self.config.threadNum or scheduler.autoWorkers()
+        # Lanes shut down in order, encodes go first since they submit copies to the other lanes
+        lanes = {"encode": threadNum, "cover": self.config.coverThreadNum}
+        for target in self.destinations:
+            lanes[target.lane] = target.config.ioThreadNum
+        self.scheduler = scheduler.Scheduler(lanes, maxQueued=self.config.maxQueuedJobs)
+        batch = []
+        for target in self.destinations:
+            target.scheduler = self.scheduler
+            target.startMoves()
+            batch.extend((target, album, album.tracks) for album in target.albums.values())
+        self.__submit(batch)
+
+    def finishSync(self):
+        """ Wait for every submitted track to finish """
+        self.scheduler.shutdown()
+        self.__stopScheduler()
+
+    def __stopScheduler(self):
+        self.scheduler = None
+        for target in self.destinations:
+            target.scheduler = None
+
+    def staleTracks(self):
+        """ [(<Destination>, [(<trackID>, <path>)])] of every synced track that wasn't found during the scan,
+            or that the destination's filters reject """
+        return [(target, target.staleTracks()) for target in self.destinations]
+
+    def prune(self, deletes=None):
+        """ Remove stale tracks from every destination, or the ones in deletes (as given by staleTracks())
+            Safe to call while tracks are being synced, their folders are never removed """
+        with timing.timer.measure("prune"):
+            for target, targetDeletes in (self.staleTracks() if deletes is None else deletes):
+                target.prune(targetDeletes)
+
+    def plan(self):
+        """ Build a SyncPlan per destination out of everything scanned so far, without touching them """
+        plans = [target.plan() for target in self.destinations]
+        # Plans of syncDestination don't name it, so they can be executed with another config
+        plans[0].destination = None
+        return plans
+
+    def summary(self, plans):
+        for plan in plans:
+            plan.summary(self.__destinationFor(plan).config.encoderSetting)
+
+    def __destinationFor(self, plan):
+        if plan.destination is None:
+            return self.destinations[0]
+        for target in self.destinations:
+            if target.root == plan.destination:
+                return target
+        raise ValueError("Plan for {}, which isn't a configured destination".format(plan.destination))
+
+    def executePlan(self, plans):
+        """ Run the plans made earlier by plan(), without scanning again """
+        deletes = []
+        for plan in plans:
+            target = self.__destinationFor(plan)
+            target.loadPlan(plan)
+            deletes.append((target, plan.deletes))
+        self.startSync()
+        self.prune(deletes)
+        self.finishSync()
+
+    def abort(self):
+        """ Save finished work right away, drop every queued track and shut down
+            The scan index isn't compacted since the scan might be incomplete """
+        for target in self.destinations:
+            target.record.flush()
+        if self.scheduler is not None:
+            self.scheduler.shutdown(cancelPending=True)
+            self.__stopScheduler()
+        for target in self.destinations:
+            target.abort()
+        self.__removeStaging()
+        self.scanIndex.close()
+        self.progress.finish()
+        self.__writeReport()
 
     def shutdown(self):
-        self.record.killAutosave()
-        self.record.write()
+        for target in self.destinations:
+            target.shutdown(self.scanned)
+        # Entries are only known to be stale after a full scan
+        if self.scanned:
+            self.scanIndex.compact()
+        self.scanIndex.close()
+        self.coverCache.report()
+        if self.transcodeCache is not None:
+            self.transcodeCache.report()
+        self.__removeStaging()
+        self.copier.stats.report()
+        self.progress.finish()
+        self.__writeReport()
 
-    @staticmethod
-    def __getFilePath(track, ext=""):
-        directory = utils.pathSanitize(track.album)
-        if track.trackNumber is None:
-            filename = "{title}{ext}"
-        else:
-            filename = "{trackNum:02d}. {title}{ext}"
-        filename = filename.format(trackNum=track.trackNumber, title=utils.pathSanitize(track.title), ext=ext)
+    def __removeStaging(self):
+        if self.stagingDirectory is not None:
+            shutil.rmtree(self.stagingDirectory, ignore_errors=True)
 
-        return os.path.join(directory, filename)
+    def __writeReport(self):
+        if self.config.runReport:
+            timing.timer.write(self.config.runReport)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Where a run spends its time
+# Every stage (traversal, tag parsing, encoding...) records one sample per call,
+# the run ends with a JSON report of wall/CPU time, bytes and latency percentiles
+# Cheap per track steps are timed per directory instead, timing them costs as much as running them
+# Timings are collected into the module-level `timer`, hooks are spread across modules
+
+import contextlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def maxRSS():
+    """ Peak resident set size of this process in bytes, None if unknown """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes everywhere but on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(samples, p):
+    """ Nearest-rank percentile of sorted samples """
+    if not samples:
+        return None
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+class Sample:
+    """ Handed out by Timer.measure(), to fill in what's only known at the end of the call """
+
+    def __init__(self, bytesIn=0):
+        self.bytesIn = bytesIn
+        self.bytesOut = 0
+
+
+class Stage:
+    # Percentiles come from a uniform sample of at most this many calls (reservoir sampling),
+    # so a stage called for every track doesn't grow without bound
+    MAX_SAMPLES = 10000
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.count = 0
+        self.maxWall = None
+        self.samples = []
+
+    def add(self, wall, cpu, bytesIn, bytesOut):
+        self.wall += wall
+        self.cpu += cpu
+        self.bytesIn += bytesIn
+        self.bytesOut += bytesOut
+        self.count += 1
+        if self.maxWall is None or wall > self.maxWall:
+            self.maxWall = wall
+        if len(self.samples) < self.MAX_SAMPLES:
+            self.samples.append(wall)
+        else:
+            index = random.randrange(self.count)
+            if index < self.MAX_SAMPLES:
+                self.samples[index] = wall
+
+    def toDict(self):
+        samples = sorted(self.samples)
+        return {
+            "count": self.count,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "bytesIn": self.bytesIn,
+            "bytesOut": self.bytesOut,
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+            "max": self.maxWall
+        }
+
+
+class Timer:
+    """ Per stage timings of a run
+        Stage CPU time is the CPU time of the calling thread, child processes (FFmpeg, waifu2x)
+        are only accounted for as a whole in the report """
+
+    def __init__(self):
+        self.threadLock = threading.Lock()
+        self.start()
+
+    def start(self):
+        with self.threadLock:
+            self.stages = {}  # <stage>:<Stage>
+            self.encodes = {}  # <codec>:[<count>, <audio seconds>, <wall>]
+            self.startTime = time.time()
+            self.startWall = time.monotonic()
+            self.startCPU = time.process_time()
+            self.startChildren = self.__childrenCPU()
+
+    @staticmethod
+    def __childrenCPU():
+        if resource is None:
+            return 0.0
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def add(self, stage, wall, cpu=0.0, bytesIn=0, bytesOut=0):
+        with self.threadLock:
+            if stage not in self.stages:
+                self.stages[stage] = Stage()
+            self.stages[stage].add(wall, cpu, bytesIn, bytesOut)
+
+    @contextlib.contextmanager
+    def measure(self, stage, bytesIn=0):
+        """ Time the body of the with statement as one sample of stage
+            Failed calls are recorded too, they took time all the same """
+        sample = Sample(bytesIn)
+        startWall = time.perf_counter()
+        startCPU = time.thread_time()
+        try:
+            yield sample
+        finally:
+            self.add(stage, time.perf_counter() - startWall, time.thread_time() - startCPU,
+                     sample.bytesIn, sample.bytesOut)
+
+    def addEncode(self, codec, audioSeconds, wall):
+        with self.threadLock:
+            entry = self.encodes.setdefault(codec, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += audioSeconds or 0
+            entry[2] += wall
+
+    def toDict(self):
+        with self.threadLock:
+            return {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.startTime)),
+                "wall": time.monotonic() - self.startWall,
+                "cpu": time.process_time() - self.startCPU,
+                "childrenCPU": self.__childrenCPU() - self.startChildren,
+                "maxRSS": maxRSS(),
+                "stages": {name: stage.toDict() for name, stage in sorted(self.stages.items())},
+                "encodes": {codec: {"count": count,
+                                    "audioSeconds": audioSeconds,
+                                    "wall": wall,
+                                    "realtimeFactor": audioSeconds / wall if wall else None}
+                            for codec, (count, audioSeconds, wall) in sorted(self.encodes.items())}
+            }
+
+    def write(self, filePath):
+        report = self.toDict()
+        tmpFile = filePath + ".tmp"
+        with open(tmpFile, "w") as f:
+            json.dump(report, f, indent=4)
+        os.replace(tmpFile, filePath)
+        logging.info("Run report written to {} ({:.1f} s wall, {:.1f} s CPU, {:.1f} s in child processes)"
+                     .format(filePath, report["wall"], report["cpu"], report["childrenCPU"]))
+
+
+timer = Timer()
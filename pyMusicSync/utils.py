@@ -1,28 +1,35 @@
 #!/usr/bin/env python3
 
+import functools
 import hashlib
 import logging
-import random
+import os
 
 import unidecode
 
 
-def genRandomString(charset, length):
-    random.seed()
-    return ''.join([random.choice(charset) for i in range(length)])
+# Illegal characters, replaced by their hex code in a single pass
+ILLEGAL_CHAR = '/?<>:*|"\\^)\0\t'
+SANITIZE_TABLE = str.maketrans({ch: "_x{:x}_".format(ord(ch)) for ch in ILLEGAL_CHAR})
 
 
-def pathSanitize(name):
-    """ Sanitize path """
-    if name is None:
-        return genRandomString("0123456789ABCDEF", 5)
+def pathSanitize(name, fallbackKey=""):
+    """ Sanitize path
+        A missing name gets a stable name derived from fallbackKey, so it ends up
+        in the same place on every call and every run
+        Tags are read as strings, a missing one may already have become "None" """
+    if name is None or name in ("", "None"):
+        return hashlib.md5(fallbackKey.encode()).hexdigest()[:5].upper()
+    return _sanitizeName(name)
+
+
+# Cached on the name alone, fallbackKey is unique per track for titles
+@functools.lru_cache(maxsize=65536)
+def _sanitizeName(name):
     # Convert Unicode character to ASCII (This need to be done first)
     # It doesn't and needn't be accurate
     result = unidecode.unidecode(name)
-    # Illegal characters
-    ILLEGAL_CHAR = '/?<>:*|"\\^)\0\t'
-    for ch in ILLEGAL_CHAR:
-        result = result.replace(ch, "_x{:x}_".format(ord(ch)))
+    result = result.translate(SANITIZE_TABLE)
     # For some reason creating a directory with trailing space on Linux
     # will cause "Invalid argument"
     result = result.strip()
@@ -34,9 +41,49 @@ def pathSanitize(name):
     return result
 
 
-def genID(metadata):
-    mtdID = "{0.album}:{0.title}:{0.duration:.3f}".format(metadata)
-    return hashlib.md5(mtdID.encode()).hexdigest()
+# How tags are hashed into track IDs, records made with an older version are migrated
+# 1: MD5
+# 2: BLAKE2b, 16 bytes digest
+# 3: content IDs include the source directory
+ID_VERSION = 3
+
+
+def genID(metadata, identity="metadata", sourceDirectory=""):
+    """ Generate a 16 bytes track ID, either from its tags or from its audio fingerprint
+        and sourceDirectory, the same recording in two albums is two tracks
+        Files (record, plans) store it as hex, see idToHex() and idFromHex() """
+    if identity == "content":
+        return hashlib.blake2b(bytes.fromhex(metadata.fingerprint) + os.fsencode(sourceDirectory),
+                               digest_size=16).digest()
+    # %-formatting is more than twice as fast as str.format() with attribute lookups
+    mtdID = "%s:%s:%.3f" % (metadata.album, metadata.title, metadata.duration)
+    return hashlib.blake2b(mtdID.encode(), digest_size=16).digest()
+
+
+def genLegacyID(metadata, identity="metadata", idVersion=1):
+    """ Track ID as generated by ID_VERSION idVersion, None if genID() still generates the same """
+    if identity == "content":
+        return bytes.fromhex(metadata.fingerprint) if idVersion < 3 else None
+    if idVersion < 2:
+        mtdID = "{0.album}:{0.title}:{0.duration:.3f}".format(metadata)
+        return hashlib.md5(mtdID.encode()).digest()
+    return None
+
+
+def idToHex(trackID):
+    return trackID.hex()
+
+
+def idFromHex(trackID):
+    return bytes.fromhex(trackID)
+
+
+def hashFile(filePath, blockSize=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filePath, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
 
 def getKey(dictionary, key, raiseCheck=False, default=None):
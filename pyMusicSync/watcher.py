@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# Watch mode, keeps the destinations in sync as the sync sources change
+# Changes are picked up with inotify on Linux, by polling the directory tree
+# everywhere else, and synced one batch of directories at a time once they settle
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import stat
+import struct
+import time
+
+from pyMusicSync import scanner
+
+
+def listTree(root):
+    """ {<directory>: {<name>: (<size>, <mtime_ns>)}} of root and every directory below it """
+    tree = {}
+    for directory, files in scanner.walk(root):
+        listing = {}
+        for entry in files:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        tree[directory] = listing
+    return tree
+
+
+class InotifyWatcher:
+    """ Reports the directories where files were written, moved or deleted
+        Files are reported once they're closed, moved in or linked, never while they're being written
+        Every directory under the roots gets its own watch, new ones are watched as they appear """
+    # From <sys/inotify.h>
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # <wd>:<directory>
+        self.writing = set()  # Files created or modified, but not closed yet
+        try:
+            for root in roots:
+                self.__watchTree(root)
+        except OSError:
+            self.close()
+            raise
+        logging.info("Watching {} directories with inotify".format(len(self.watches)))
+
+    def __watchTree(self, root):
+        for directory, _ in scanner.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd >= 0:
+                self.watches[wd] = directory
+                continue
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, "Out of inotify watches, see fs.inotify.max_user_watches")
+            # Removed since it was listed, its parent reports that
+            logging.debug("Unable to watch {}: {}".format(directory, os.strerror(error)))
+
+    def poll(self, timeout):
+        """ Wait up to timeout seconds (None for the next change), return the set of changed directories """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changes = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0")
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    logging.warning("inotify queue overflowed, rescanning every sync source")
+                    changes.update(self.roots)
+                elif mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                elif wd in self.watches:
+                    self.__handle(self.watches[wd], os.fsdecode(name), mask, changes)
+
+    def __handle(self, directory, name, mask, changes):
+        path = os.path.join(directory, name)
+        if not mask & self.IN_ISDIR:
+            if mask & self.IN_MODIFY:
+                # A file being written isn't complete yet, IN_CLOSE_WRITE follows once it is
+                self.writing.add(path)
+            elif mask & self.IN_CREATE:
+                # Links are complete as soon as they're created, and never get IN_CLOSE_WRITE
+                if self.__isLink(path):
+                    changes.add(directory)
+            else:
+                self.writing.discard(path)
+                changes.add(directory)
+        elif mask & (self.IN_CREATE | self.IN_MOVED_TO):
+            # Files may have landed in it before its watch was added, the whole subtree gets scanned
+            self.__watchTree(path)
+            changes.add(path)
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            changes.add(path)
+
+    @staticmethod
+    def __isLink(path):
+        """ Whether path is a symlink or a hard link, rather than a new file about to be written """
+        try:
+            info = os.lstat(path)
+        except OSError:
+            return False
+        return stat.S_ISLNK(info.st_mode) or info.st_nlink > 1
+
+    def isWriting(self, directory):
+        """ Whether a file in directory or below is still open for writing """
+        prefix = os.path.join(directory, "")
+        return any(path.startswith(prefix) for path in self.writing)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """ Reports changed directories by comparing listings every interval seconds
+        A directory is only reported once its listing stayed the same for a whole interval,
+        so files still being copied in aren't synced half written """
+
+    def __init__(self, roots, interval):
+        self.roots = roots
+        self.interval = interval
+        self.snapshot = self.__snapshot()
+        self.unsettled = set()
+        self.nextPoll = time.monotonic() + interval
+        logging.info("Polling {} directories every {} s".format(len(self.snapshot), interval))
+
+    def __snapshot(self):
+        snapshot = {}
+        for root in self.roots:
+            snapshot.update(listTree(root))
+        return snapshot
+
+    def poll(self, timeout):
+        """ Wait up to timeout seconds (None for the next poll), return the set of changed directories """
+        remaining = self.nextPoll - time.monotonic()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0, remaining))
+        self.nextPoll = time.monotonic() + self.interval
+        snapshot = self.__snapshot()
+        changed = {directory for directory in set(snapshot) | set(self.snapshot)
+                   if snapshot.get(directory) != self.snapshot.get(directory)}
+        self.snapshot = snapshot
+        settled = self.unsettled - changed
+        self.unsettled = changed
+        return settled
+
+    def isWriting(self, directory):
+        # Only settled directories are reported
+        return False
+
+    def close(self):
+        pass
+
+
+def createWatcher(roots, method="auto", pollInterval=30):
+    """ Start watching roots, create it before scanning them so nothing changed in the meantime is missed """
+    if method in ("auto", "inotify"):
+        try:
+            return InotifyWatcher(roots)
+        except OSError as e:
+            if method == "inotify":
+                raise
+            logging.warning("Unable to use inotify ({}), falling back to polling".format(e))
+    return PollingWatcher(roots, pollInterval)
+
+
+def watch(sync, config, watcher):
+    """ Sync the changes reported by watcher until interrupted
+        A batch is synced once no change came in for watchDebounce seconds,
+        or watchMaxDelay seconds after its first change, whichever comes first
+        Directories whose files still change in size or mtime wait for the next batch
+        whatever the watcher says, a file copied in slowly is never synced half written """
+    pending = {}  # <directory>:<listTree() at the last check, None before the first one>
+    firstChange = lastChange = None
+    try:
+        while True:
+            changes = watcher.poll(config.watchDebounce if pending else None)
+            now = time.monotonic()
+            if changes:
+                for directory in changes:
+                    pending.setdefault(directory, None)
+                lastChange = now
+                firstChange = firstChange or now
+            if pending and (now - lastChange >= config.watchDebounce or now - firstChange >= config.watchMaxDelay):
+                settled = settle(pending, watcher)
+                if settled:
+                    logging.info("Syncing changes in {} directories".format(len(settled)))
+                    sync.syncDirectories(settled)
+                firstChange = lastChange = (time.monotonic() if pending else None)
+    finally:
+        watcher.close()
+
+
+def settle(pending, watcher):
+    """ Remove and return the directories of pending whose listing didn't change since the last check,
+        and where watcher doesn't know of any file still being written """
+    settled = []
+    for directory, previous in list(pending.items()):
+        current = listTree(directory)
+        if current == previous and not watcher.isWriting(directory):
+            settled.append(directory)
+            del pending[directory]
+        else:
+            pending[directory] = current
+    return settled